@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Size and random read time of descriptions: bz2 tar bucket (pack.sh) vs
+# records compressed one by one, plain zlib and with trained dictionary (codec.py).
+# python3 ./bench_codec.py --folder descr/000      (loose description files)
+# python3 ./bench_codec.py --count 1000            (synthetic descriptions)
+
+import argparse
+import io
+import os
+import random
+import tarfile
+import time
+
+import codec
+
+
+def synthetic(count):
+    random.seed(1)
+    words = ['Год выпуска', 'Жанр', 'Продолжительность', 'Перевод', 'Субтитры', 'Режиссер', 'В ролях', 'Описание',
+             'Качество', 'Формат', 'Видео', 'Аудио', 'Размер', 'Страна', 'Издатель']
+    records = []
+    for i in range(count):
+        parts = ['<div class="post_body" id="p-%i">' % (random.randrange(10 ** 7))]
+        for j in range(random.randint(8, 30)):
+            word = random.choice(words)
+            value = ' '.join('%x' % random.randrange(16 ** random.randint(2, 8)) for k in range(random.randint(1, 12)))
+            parts.append('<span class="post-b">%s</span>: %s<br />' % (word, value))
+            if random.random() < 0.2:
+                parts.append('<div class="sp-wrap"><div class="sp-head folded"><span>%s</span></div>'
+                             '<div class="sp-body"><var class="postImg" title="http://i%i.fastpic.ru/big/%i.png">'
+                             '&#10;</var></div></div>' % (word, random.randrange(100), random.randrange(10 ** 9)))
+        parts.append('</div>')
+        records.append(''.join(parts).encode('utf8'))
+    return records
+
+
+def bench_bz2(records, reads):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:bz2') as archive:
+        for i, record in enumerate(records):
+            info = tarfile.TarInfo('%08i' % i)
+            info.size = len(record)
+            archive.addfile(info, io.BytesIO(record))
+    data = buffer.getvalue()
+    start = time.perf_counter()
+    for i in reads:
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r:bz2') as archive:
+            archive.extractfile('%08i' % i).read()
+    return len(data), (time.perf_counter() - start) / len(reads)
+
+
+def bench_codec(records, reads, record_codec):
+    compressed = [record_codec.compress(record) for record in records]
+    start = time.perf_counter()
+    for i in reads:
+        record_codec.decompress(compressed[i])
+    return sum(map(len, compressed)) + len(record_codec.dictionary), (time.perf_counter() - start) / len(reads)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--folder', help='folder with description files, else synthetic ones')
+    ap.add_argument('--count', type=int, default=1000)
+    ap.add_argument('--reads', type=int, default=50)
+    options = ap.parse_args()
+
+    if options.folder:
+        names = sorted(name for name in os.listdir(options.folder) if name.isdigit())[:options.count]
+        records = [open(os.path.join(options.folder, name), 'rb').read() for name in names]
+    else:
+        records = synthetic(options.count)
+    # dictionary from every second record, the others are measured
+    trained = codec.train(records[::2])
+    records = records[1::2]
+    reads = [random.randrange(len(records)) for i in range(options.reads)]
+    raw = sum(map(len, records))
+    print('measured records: %i, %.1f KB' % (len(records), raw / 1024))
+    for name, (size, read_time) in (('bz2 tar bucket', bench_bz2(records, reads)),
+                                    ('zlib per record', bench_codec(records, reads, codec.Codec())),
+                                    ('%s per record' % trained.name, bench_codec(records, reads, trained))):
+        print('%-22s ratio: %5.2f  random read: %8.3f ms' % (name, raw / size, read_time * 1000))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Correctness and speed of parse.parse_page on pages of corpus/.
+# Every corpus/<id>_<case>.html has expected result in corpus/<id>_<case>.json.
+# python3 ./bench_parser.py --check      (compare with expected results, exit code 1 on difference)
+# python3 ./bench_parser.py --update     (write expected results after intended parser change)
+# python3 ./bench_parser.py --seconds 3  (docs/sec on one and on all cores, memory per doc)
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+import parse
+import record
+
+log = logging.getLogger('bench_parser')
+log.setLevel(logging.CRITICAL + 1)  # error branches log warnings
+logging.getLogger('record').setLevel(logging.CRITICAL + 1)  # unknown date format of corpus page
+
+
+def load_corpus(folder):
+    pages = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.html'):
+            id = int(name.split('_', 1)[0])
+            html = open(os.path.join(folder, name), encoding='utf8').read()
+            pages.append((os.path.join(folder, name[:-len('.html')]), id, html))
+    return pages
+
+
+def result_of(id, html):
+    status, result = parse.parse_page(html, id, log)
+    if 'record' in result:
+        # typed fields, hash as hex
+        row = result['record']
+        result['record'] = dict((name, getattr(row, name)) for name in record.columns)
+        result['record']['hash'] = row.hash_hex()
+    return {'status': status, 'result': result}
+
+
+def check(pages, update=False):
+    failed = 0
+    for path, id, html in pages:
+        result = result_of(id, html)
+        if update:
+            with open(path + '.json', 'w', encoding='utf8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=1, sort_keys=True)
+                f.write('\n')
+            continue
+        expected = json.load(open(path + '.json', encoding='utf8'))
+        if result != expected:
+            failed += 1
+            print('FAIL %s\n  expected: %s\n  got:      %s' % (os.path.basename(path), expected, result))
+    if not update:
+        print('%i pages, %i failed' % (len(pages), failed))
+    return failed
+
+
+def parse_for(pages, seconds):
+    count = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        for path, id, html in pages:
+            parse.parse_page(html, id, log)
+        count += len(pages)
+    return count
+
+
+def memory_per_doc(pages):
+    # peak of memory allocated while parsing one page (beyond the page itself)
+    peaks = []
+    tracemalloc.start()
+    for path, id, html in pages:
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        parse.parse_page(html, id, log)
+        peaks.append(tracemalloc.get_traced_memory()[1] - start)
+    tracemalloc.stop()
+    return sum(peaks) / len(peaks)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--corpus', default='corpus')
+    ap.add_argument('--check', action="store_true")
+    ap.add_argument('--update', action="store_true")
+    ap.add_argument('--seconds', type=float, default=2)
+    ap.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    options = ap.parse_args()
+
+    pages = load_corpus(options.corpus)
+    if options.check or options.update:
+        sys.exit(1 if check(pages, options.update) else 0)
+
+    if check(pages):
+        sys.exit(1)
+    size = sum(len(html.encode('utf8')) for path, id, html in pages) / len(pages)
+    count = parse_for(pages, options.seconds)
+    print('1 process:   %9.0f docs/sec  %6.1f MB/sec' % (count / options.seconds, count * size / options.seconds / 2 ** 20))
+    with ProcessPoolExecutor(options.processes) as executor:
+        counts = list(executor.map(parse_for, [pages] * options.processes, [options.seconds] * options.processes))
+    count = sum(counts)
+    print('%i processes: %9.0f docs/sec  %6.1f MB/sec' % (options.processes, count / options.seconds,
+                                                          count * size / options.seconds / 2 ** 20))
+    print('memory: %.1f KB peak per doc (%.1f KB per page)' % (memory_per_doc(pages) / 1024, size / 1024))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# SOCKS5 handshake micro-benchmark against local SOCKS5 stand-in.
+# Compares sequential handshake with pipelined one (socks.pipeline_socks5).
+# python3 ./bench_socks.py --connections 200 --delay 5
+
+import argparse
+import socket
+import struct
+import threading
+import time
+from multiprocessing import Process, Queue
+
+import socks
+
+
+def recv_exact(conn, count):
+    data = b''
+    while len(data) < count:
+        d = conn.recv(count - len(data))
+        if not d:
+            raise ConnectionError('closed')
+        data += d
+    return data
+
+
+def reply_at(conn, data, when):
+    pause = when - time.perf_counter()
+    if pause > 0:
+        time.sleep(pause)
+    conn.sendall(data)
+
+
+def handle(conn, delay):
+    # minimal no-auth SOCKS5 server, each reply is sent "delay" after
+    # the data it answers has arrived (emulates network round trip)
+    try:
+        ver, nmethods = recv_exact(conn, 2)
+        recv_exact(conn, nmethods)
+        arrived = time.perf_counter()
+        conn.setblocking(False)
+        try:
+            pipelined = bool(conn.recv(1, socket.MSG_PEEK))
+        except BlockingIOError:
+            pipelined = False
+        conn.setblocking(True)
+        reply_at(conn, b'\x05\x00', arrived + delay)
+        ver, cmd, rsv, atyp = recv_exact(conn, 4)
+        if atyp == 1:
+            recv_exact(conn, 4)
+        elif atyp == 3:
+            recv_exact(conn, recv_exact(conn, 1)[0])
+        recv_exact(conn, 2)
+        if not pipelined:
+            arrived = time.perf_counter()
+        reply_at(conn, b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', 80), arrived + delay)
+        conn.recv(1)  # wait for client to close
+    except ConnectionError:
+        pass
+    finally:
+        conn.close()
+
+
+def server(port_queue, delay):
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    port_queue.put(listener.getsockname()[1])
+    while True:
+        conn, addr = listener.accept()
+        threading.Thread(target=handle, args=(conn, delay), daemon=True).start()
+
+
+def run(port, connections):
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    for i in range(connections):
+        s = socks.socksocket()
+        s.setproxy(socks.PROXY_TYPE_SOCKS5, '127.0.0.1', port)
+        s.connect(('10.0.0.1', 443))
+        s.close()
+    return (time.perf_counter() - wall) / connections, (time.process_time() - cpu) / connections
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--connections', '-n', type=int, default=200)
+    ap.add_argument('--delay', type=float, default=5, help='server reply delay in ms (emulated latency)')
+    options = ap.parse_args()
+
+    port_queue = Queue()
+    p = Process(target=server, args=(port_queue, options.delay / 1000), daemon=True)
+    p.start()
+    port = port_queue.get()
+
+    for pipeline in (False, True):
+        socks.pipeline_socks5 = pipeline
+        wall, cpu = run(port, options.connections)
+        print('%-10s  %7.2f ms/connection (%4.1f round trips of %.1f ms),  cpu %6.1f us/connection' % (
+            'pipelined' if pipeline else 'sequential', wall * 1000, wall * 1000 / options.delay if options.delay else 0,
+            options.delay, cpu * 1000000))
+    p.terminate()
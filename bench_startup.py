@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+# Measures time from starting viewer.py until its window is shown.
+# python3 ./bench_startup.py --runs 10 [--offscreen]
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ap = argparse.ArgumentParser()
+ap.add_argument('--runs', '-n', type=int, default=5)
+ap.add_argument('--offscreen', action="store_true", help='use offscreen qt platform (no display needed)')
+ap.add_argument('--target', type=float, default=1.0, help='target time in seconds')
+options = ap.parse_args()
+
+env = dict(os.environ)
+if options.offscreen:
+    env['QT_QPA_PLATFORM'] = 'offscreen'
+viewer = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer.py')
+
+wall_times = []
+module_times = []
+for i in range(options.runs):
+    start = time.perf_counter()
+    p = subprocess.Popen([sys.executable, viewer, '--startup-benchmark'], stdout=subprocess.PIPE, env=env,
+                         universal_newlines=True)
+    for line in p.stdout:
+        if line.startswith('startup: '):
+            wall_times.append(time.perf_counter() - start)
+            module_times.append(float(line.split()[1]))
+            break
+    p.wait()
+    if len(wall_times) <= i:
+        print('viewer exited without showing window (code %i)' % p.returncode)
+        sys.exit(1)
+    print('run %2i: %.3f s (%.3f s after interpreter start)' % (i + 1, wall_times[-1], module_times[-1]))
+
+median = statistics.median(wall_times)
+print('median: %.3f s, min: %.3f s, max: %.3f s' % (median, min(wall_times), max(wall_times)))
+print('target %.1f s: %s' % (options.target, 'OK' if median < options.target else 'FAILED'))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+# Memory and throughput of loader workers as processes vs threads (--workers).
+# Pages come from a local http server with emulated latency instead of rutracker.
+# python3 ./bench_workers.py --workers 50 --pages 2000 --delay 50
+# python3 ./bench_workers.py --check      (thread workers send cookie of their own task, exit code 1 if not)
+
+import argparse
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process
+
+import requests
+
+import loader
+import parse
+import record
+
+page = ('<html><body>' + 'x' * 40000 + '</body></html>').encode()
+delay = 0.05
+url = None
+cookies_seen = {}  # id -> Cookie header of its request
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if 't=' in self.path:
+            cookies_seen[int(self.path.split('t=')[1])] = self.headers.get('Cookie')
+        time.sleep(delay)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), PageHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def fake_get_page(params):
+    res = {k: v for k, v in params.items() if k not in ('logger', 'session')}
+    r = requests.get(url, timeout=20)
+    res['record'] = record.Record(params['id'], 'page', len(r.content), 0, 0, bytes(20), 0, 0, '')
+    res['description'] = ''
+    return 'OK', res
+
+
+def memory_kb(pid):
+    # proportional set size - pages shared after fork are counted once
+    for filename, field in (('/proc/%i/smaps_rollup' % pid, 'Pss:'), ('/proc/%i/status' % pid, 'VmRSS:')):
+        try:
+            for line in open(filename):
+                if line.startswith(field):
+                    return int(line.split()[1])
+        except OSError:
+            pass
+    return 0
+
+
+def bench_settings(mode, workers):
+    return type('BenchSettings', (), {'workers_mode': mode, 'threads_num': workers, 'warm_connections': 0,
+                                      'headers': {}, 'profile_folder': None, 'spool_folder': None,
+                                      'spool_above': 0})()
+
+
+def check_cookies(workers, pages):
+    """Thread workers with real parse.get_page, two logins: each request must go with cookie of its task"""
+    real_page_url = parse.page_url
+    parse.page_url = url + 'forum/viewtopic.php?t=%i'
+    try:
+        task_queue, done_queue, started = loader.start_workers(bench_settings('thread', workers))
+        headers = {}  # one dict in all tasks, get_page must not write into it
+        for id in range(pages):
+            task_queue.put(('GET_PAGE', {'id': id, 'cookie': 'login%i' % (id % 2), 'headers': headers,
+                                         'proxy_ip': '', 'proxy_port': -1}))
+        for done in range(pages):
+            done_queue.get()
+        for worker in started:
+            task_queue.put(('STOP', {}))
+        for worker in started:
+            worker.join()
+    finally:
+        parse.page_url = real_page_url
+    wrong = [id for id in range(pages) if cookies_seen.get(id) != 'login%i' % (id % 2)]
+    print('cookies: %i pages, %i sent with wrong cookie' % (pages, len(wrong)))
+    return not wrong
+
+
+def run(mode, workers, pages):
+    settings = bench_settings(mode, workers)
+    task_queue, done_queue, started = loader.start_workers(settings)
+    start = time.perf_counter()
+    for id in range(pages):
+        task_queue.put(('GET_PAGE', {'id': id, 'proxy_ip': '', 'proxy_port': -1}))
+    peak = 0
+    for done in range(pages):
+        done_queue.get()
+        if done % 100 == 0:
+            pids = [os.getpid()] + [p.pid for p in started if isinstance(p, Process)]
+            peak = max(peak, sum(memory_kb(pid) for pid in pids))
+    elapsed = time.perf_counter() - start
+    for worker in started:
+        task_queue.put(('STOP', {}))
+    for worker in started:
+        worker.join()
+    print('%-8s workers: %4i  pages/sec: %7.1f  memory: %7.1f MB' % (mode, workers, pages / elapsed, peak / 1024))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--workers', type=int, default=50)
+    ap.add_argument('--pages', type=int, default=2000)
+    ap.add_argument('--delay', type=float, default=50, help='page latency, ms')
+    ap.add_argument('--port', type=int, default=18080)
+    ap.add_argument('--mode', choices=('process', 'thread', 'both'), default='both')
+    ap.add_argument('--check', action="store_true")
+    options = ap.parse_args()
+
+    delay = options.delay / 1000
+    url = 'http://127.0.0.1:%i/' % options.port
+    threading.Thread(target=serve, args=(options.port,), daemon=True).start()
+    loader.page_delay = 0
+    if options.check:
+        sys.exit(0 if check_cookies(options.workers, min(options.pages, 500)) else 1)
+    parse.get_page = fake_get_page
+    for mode in (('process', 'thread') if options.mode == 'both' else (options.mode,)):
+        run(mode, options.workers, options.pages)
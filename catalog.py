@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+
+"""Catalog of torrents in sqlite, alternative to table.txt/table_sorted for search.
+
+One row per id (re-crawled ids replace old rows), FTS5 trigram index on
+name for word search, indexes on seeds, date and size for ordering, so no
+sort.py step is needed.
+
+Categories (breadcrumb 'Forum | Subforum | ...') are kept once in a tree
+table with count of rows in each, rows refer to them by id. Category
+filter (words of path, or id of a tree node with its subcategories) is
+matched against the small category table and then goes through the index
+on category_id.
+
+Usage (standalone):
+    python3 ./catalog.py import table.bin     # build catalog.db from table (or table.txt)
+    python3 ./catalog.py stats
+    python3 ./catalog.py categories           # category tree with counts
+    python3 ./catalog.py migrate              # convert catalog made before categories table
+"""
+
+import argparse
+import logging
+import math
+import os
+import sqlite3
+
+import record
+from record import parse_date, format_date
+
+catalog_file = 'catalog.db'
+
+columns = record.columns
+int_columns = ('id', 'size', 'seeds', 'peers', 'downloads')
+sort_columns = ('seeds', 'peers', 'downloads', 'size', 'date', 'id', 'relevance')
+
+schema = '''
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY,
+    parent INTEGER,
+    name TEXT,
+    path TEXT UNIQUE,
+    count INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS torrents (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    size INTEGER,
+    seeds INTEGER,
+    peers INTEGER,
+    hash TEXT,
+    downloads INTEGER,
+    date INTEGER,
+    category_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS torrents_seeds ON torrents (seeds);
+CREATE INDEX IF NOT EXISTS torrents_date ON torrents (date);
+CREATE INDEX IF NOT EXISTS torrents_size ON torrents (size);
+CREATE INDEX IF NOT EXISTS torrents_category ON torrents (category_id, seeds);
+CREATE VIRTUAL TABLE IF NOT EXISTS torrents_fts USING fts5 (
+    name, content='torrents', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS torrents_insert AFTER INSERT ON torrents BEGIN
+    INSERT INTO torrents_fts (rowid, name) VALUES (new.id, new.name);
+    UPDATE categories SET count = count + 1 WHERE id = new.category_id;
+END;
+CREATE TRIGGER IF NOT EXISTS torrents_delete AFTER DELETE ON torrents BEGIN
+    INSERT INTO torrents_fts (torrents_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    UPDATE categories SET count = count - 1 WHERE id = old.category_id;
+END;
+CREATE TRIGGER IF NOT EXISTS torrents_update AFTER UPDATE ON torrents BEGIN
+    INSERT INTO torrents_fts (torrents_fts, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO torrents_fts (rowid, name) VALUES (new.id, new.name);
+    UPDATE categories SET count = count - 1 WHERE id = old.category_id;
+    UPDATE categories SET count = count + 1 WHERE id = new.category_id;
+END;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+category_separator = ' | '
+
+# filename -> (version of file, [(path, id)], {words or ('subtree', id): matching ids}),
+# shared by Catalog objects, search opens new one for every query
+_category_cache = {}
+
+
+def file_version(filename):
+    """mtime and size of database and its WAL, every commit changes it"""
+    version = []
+    for name in (filename, filename + '-wal'):
+        try:
+            stat = os.stat(name)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.append(None)
+    return tuple(version)
+
+
+def to_int(text):
+    try:
+        return int(text)
+    except ValueError:
+        return 0
+
+
+def contains(text, word):
+    # sqlite lower() and LIKE fold only ascii
+    return word in (text or '').lower()
+
+
+def relevance(name, seeds, words):
+    """Matched words (whole word counts twice) plus log10 of seeds, words are lowercased"""
+    name = (name or '').lower()
+    score = 0
+    for w in words:
+        pos = name.find(w)
+        if pos == -1:
+            continue
+        score += 1
+        end = pos + len(w)
+        if (pos == 0 or not name[pos - 1].isalnum()) and (end == len(name) or not name[end].isalnum()):
+            score += 1
+    return score + math.log10(1 + max(seeds or 0, 0))
+
+
+def split_order(order):
+    """'date' - biggest first, '-date' - smallest first -> (column, ascending)"""
+    column = order.lstrip('-')
+    if column not in sort_columns:
+        raise ValueError('unknown sort column: %s' % column)
+    return column, order.startswith('-')
+
+
+def fts_phrase(word):
+    return '"%s"' % word.replace('"', '""')
+
+
+class OldCatalogError(ValueError):
+    """Catalog made before categories table, opened readonly"""
+
+
+class Catalog:
+    def __init__(self, filename=catalog_file, readonly=False, batch_size=500):
+        self.log = logging.getLogger(__name__)
+        self.batch_size = batch_size
+        self.pending = []
+        self.filename = os.path.abspath(filename)
+        self.category_ids = None  # path -> id
+        if readonly:
+            self.db = sqlite3.connect('file:%s?mode=ro' % filename, uri=True, check_same_thread=False)
+            if self.has_category_text():
+                # readonly user (viewer, search) doesn't write, conversion is done on purpose
+                self.db.close()
+                raise OldCatalogError('%s is made before categories table, convert it by: python3 ./catalog.py migrate'
+                                 % filename)
+        else:
+            self.db = sqlite3.connect(filename)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            if self.has_category_text():
+                self.migrate()
+            else:
+                self.db.executescript(schema)
+        self.db.create_function('contains', 2, contains, deterministic=True)
+        self.db.create_function('relevance', 3, lambda name, seeds, words: relevance(name, seeds, words.split('\t')),
+                                deterministic=True)
+
+    def has_category_text(self):
+        # catalog made before categories table - category text in every row
+        return 'category' in [row[1] for row in self.db.execute('PRAGMA table_info(torrents)')]
+
+    def migrate(self):
+        self.log.info('moving categories of catalog into categories table')
+        with self.db:
+            for name in ('torrents_insert', 'torrents_delete', 'torrents_update'):
+                self.db.execute('DROP TRIGGER IF EXISTS %s' % name)
+            for name in ('torrents_seeds', 'torrents_date', 'torrents_size'):
+                self.db.execute('DROP INDEX IF EXISTS %s' % name)
+            self.db.execute('DROP TABLE IF EXISTS torrents_fts')
+            self.db.execute('ALTER TABLE torrents RENAME TO torrents_old')
+        self.db.executescript(schema)
+        for row in self.db.execute('SELECT %s FROM torrents_old' % ', '.join(columns)).fetchall():
+            self.add(self.row_to_item(row))
+        self.flush()
+        with self.db:
+            self.db.execute('DROP TABLE torrents_old')
+        self.db.execute('VACUUM')
+
+    def load_categories(self):
+        self.category_ids = dict((path, id) for id, path in self.db.execute('SELECT id, path FROM categories'))
+
+    def category_id(self, path):
+        """Id of category (created with its parents if new)"""
+        if self.category_ids is None:
+            self.load_categories()
+        if not path:
+            return None
+        if path not in self.category_ids:
+            names = path.split(category_separator)
+            parent = self.category_id(category_separator.join(names[:-1])) if len(names) > 1 else None
+            cursor = self.db.execute('INSERT INTO categories (parent, name, path) VALUES (?, ?, ?)', (parent, names[-1], path))
+            self.category_ids[path] = cursor.lastrowid
+        return self.category_ids[path]
+
+    def cached_categories(self):
+        version = file_version(self.filename)
+        cached = _category_cache.get(self.filename)
+        if cached is None or cached[0] != version:
+            self.load_categories()
+            cached = _category_cache[self.filename] = (version, list(self.category_ids.items()), {})
+        return cached[1], cached[2]
+
+    def match_categories(self, words_category):
+        """Ids of categories whose path has all the words (lowercased)"""
+        key = frozenset(words_category)
+        paths, matches = self.cached_categories()
+        if key not in matches:
+            matches[key] = [id for path, id in paths if all(w in path.lower() for w in key)]
+        return matches[key]
+
+    def subtree_categories(self, category_id):
+        """Ids of category and its subcategories (empty if there is no such category)"""
+        key = ('subtree', category_id)
+        paths, matches = self.cached_categories()
+        if key not in matches:
+            top = [path for path, id in paths if id == category_id]
+            matches[key] = [id for path, id in paths
+                            if top and (path == top[0] or path.startswith(top[0] + category_separator))]
+        return matches[key]
+
+    def add(self, item):
+        """Add or replace row (list of column strings as in table.txt), written in batches"""
+        item = list(item) + [''] * (len(columns) - len(item))
+        row = [to_int(value) if column in int_columns else value for column, value in zip(columns, item)]
+        row[columns.index('date')] = parse_date(item[columns.index('date')])
+        row[columns.index('category')] = item[columns.index('category')]
+        self.append(row)
+
+    def add_record(self, row):
+        """Add or replace record.Record, written in batches"""
+        self.append(record_row(row))
+
+    def append(self, row):
+        self.pending.append(row)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.db:
+            self.write(self.pending)
+        self.pending = []
+
+    def write(self, rows):
+        # inside transaction of caller
+        for row in rows:
+            row[columns.index('category')] = self.category_id(row[columns.index('category')])
+        self.db.executemany('INSERT INTO torrents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET '
+                            'name = excluded.name, size = excluded.size, seeds = excluded.seeds, '
+                            'peers = excluded.peers, hash = excluded.hash, downloads = excluded.downloads, '
+                            'date = excluded.date, category_id = excluded.category_id', rows)
+
+    def apply_changes(self, records, removed_ids, meta=None):
+        """Add or replace records, delete rows of removed_ids and set meta (dict) in one transaction"""
+        self.flush()
+        try:
+            with self.db:
+                rows = []
+                for row in records:
+                    rows.append(record_row(row))
+                    if len(rows) >= self.batch_size:
+                        self.write(rows)
+                        rows = []
+                self.write(rows)
+                self.db.executemany('DELETE FROM torrents WHERE id = ?', ((id,) for id in removed_ids))
+                self.db.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', (meta or {}).items())
+        except Exception:
+            # ids of categories created in the transaction are gone
+            self.category_ids = None
+            raise
+
+    def get_meta(self, key):
+        try:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None  # catalog made before meta table (opened read only)
+        return row[0] if row else None
+
+    def records(self):
+        """Yield all rows as record.Record"""
+        cursor = self.db.execute('SELECT torrents.id, torrents.name, size, seeds, peers, hash, downloads, date, path '
+                                 'FROM torrents LEFT JOIN categories ON categories.id = torrents.category_id')
+        for id, name, size, seeds, peers, hash, downloads, date, path in cursor:
+            yield record.Record(id, name, size, seeds, peers, bytes.fromhex(hash), downloads, date, path or '')
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    @staticmethod
+    def row_to_item(row):
+        item = [str(value) if value is not None else '' for value in row]
+        item[columns.index('date')] = format_date(row[columns.index('date')])
+        return item
+
+    def search(self, words_contains, words_not_contains, words_category, limit, order='seeds', category_id=None):
+        """Yield first limit rows (lists of column strings like table.txt) matching query in order
+
+        category_id - only rows of this category and its subcategories
+        """
+        column, ascending = split_order(order)
+        terms = []
+        conditions = []
+        params = []
+        for w in (w.lower() for w in words_contains if w):
+            if len(w) >= 3:
+                # trigram index can only look for 3+ characters
+                terms.append(fts_phrase(w))
+            else:
+                conditions.append('contains(torrents.name, ?)')
+                params.append(w)
+        for w in (w.lower() for w in words_not_contains if w):
+            conditions.append('NOT contains(torrents.name, ?)')
+            params.append(w)
+        if terms:
+            conditions.insert(0, 'torrents.id IN (SELECT rowid FROM torrents_fts WHERE torrents_fts MATCH ?)')
+            params.insert(0, ' AND '.join(terms))
+        category_ids = None
+        if category_id is not None:
+            category_ids = self.subtree_categories(category_id)
+        words_category = [w.lower() for w in words_category if w]
+        if words_category:
+            matched = set(self.match_categories(words_category))
+            category_ids = [id for id in (matched if category_ids is None else category_ids) if id in matched]
+        if category_ids is not None:
+            if not category_ids:
+                return
+            conditions.append('category_id IN (%s)' % ', '.join(map(str, category_ids)))
+        query = ('SELECT %s, categories.path FROM torrents LEFT JOIN categories ON categories.id = category_id'
+                 % ', '.join('torrents.' + column for column in columns[:-1]))
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        if column == 'relevance':
+            query += ' ORDER BY relevance(torrents.name, torrents.seeds, ?)'
+            params.append('\t'.join(w.lower() for w in words_contains if w))
+        else:
+            query += ' ORDER BY torrents.%s' % column
+        query += ' ASC LIMIT ?' if ascending else ' DESC LIMIT ?'
+        params.append(limit)
+        for row in self.db.execute(query, params):
+            yield self.row_to_item(row)
+
+    def category_tree(self):
+        """Categories as list of dicts (id, parent, name, path, count, total), parents first.
+
+        count - rows in the category itself, total - with subcategories.
+        """
+        categories = [dict(zip(('id', 'parent', 'name', 'path', 'count'), row))
+                      for row in self.db.execute('SELECT id, parent, name, path, count FROM categories ORDER BY path')]
+        by_id = dict((category['id'], category) for category in categories)
+        for category in categories:
+            category['total'] = 0
+        for category in categories:
+            parent = category
+            while parent:
+                parent['total'] += category['count']
+                parent = by_id.get(parent['parent'])
+        return categories
+
+    def stats(self):
+        return {'rows': self.db.execute('SELECT COUNT(*) FROM torrents').fetchone()[0],
+                'categories': self.db.execute('SELECT COUNT(*) FROM categories').fetchone()[0]}
+
+
+def record_row(row):
+    return [row.id, row.name, row.size, row.seeds, row.peers, row.hash_hex(), row.downloads, row.date, row.category]
+
+
+def import_table(catalog, filename):
+    count = 0
+    if filename.endswith('.txt'):
+        for line in open(filename, encoding='utf8'):
+            item = line.rstrip('\n').split('\t')
+            if item[0].isdigit():
+                catalog.add(item)
+                count += 1
+    else:
+        for row in record.read_table(filename):
+            catalog.add_record(row)
+            count += 1
+    catalog.flush()
+    return count
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='sqlite catalog of torrents')
+    ap.add_argument('command', choices=('import', 'stats', 'categories', 'migrate'))
+    ap.add_argument('table', nargs='?', default='table.bin')
+    ap.add_argument('--catalog', default=catalog_file)
+    options = ap.parse_args()
+
+    if options.command == 'import':
+        catalog = Catalog(options.catalog)
+        print('imported: %i' % import_table(catalog, options.table))
+    else:
+        if not os.path.isfile(options.catalog):
+            ap.exit(1, 'no %s\n' % options.catalog)
+        try:
+            # opened for writing, old catalog is converted
+            catalog = Catalog(options.catalog, readonly=options.command != 'migrate')
+        except ValueError as e:
+            ap.exit(1, '%s\n' % e)
+    if options.command == 'categories':
+        for category in catalog.category_tree():
+            print('%8i  %s%s' % (category['total'], '    ' * category['path'].count(category_separator), category['name']))
+    else:
+        for key, value in catalog.stats().items():
+            print('%-10s %i' % (key, value))
+    catalog.close()
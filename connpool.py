@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+import logging
+import socket
+import threading
+import time
+from collections import deque
+
+import requests
+import socks
+
+warm_url = 'https://rutracker.org/forum/index.php'
+
+
+class ProxyConnectionManager:
+    """Keeps warm (already connected through proxy, TLS done) sessions to rutracker.
+
+    Each session is a requests.Session whose keep-alive connection was
+    opened through one proxy. A background thread opens new ones for
+    proxies used recently, drops sessions idle longer than max_idle and
+    hands them out by acquire(), so proxy negotiation and TLS handshake are
+    not paid inside the page fetch.
+    """
+
+    def __init__(self, headers, warm_per_proxy=1, max_idle=50, max_proxies=4, timeout=20):
+        self.log = logging.getLogger(__name__)
+        self.headers = dict(headers)
+        self.headers.pop('Cookie', None)
+        self.warm_per_proxy = warm_per_proxy
+        self.max_idle = max_idle  # servers close idle keep-alive connections after a minute
+        self.max_proxies = max_proxies
+        self.timeout = timeout
+        # (ip, port) -> {'sessions': deque of (time, session), 'in_use': count, 'used': time, 'lock': Lock, ...}
+        self.proxies = {}
+        self.lock = threading.Lock()  # only for self.proxies dict
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.stats = {'warm': 0, 'cold': 0, 'opened': 0, 'failed': 0, 'dropped': 0}
+        # sockets created by requests have to go through socks
+        socket.socket = socks.socksocket
+        self.thread = threading.Thread(target=self.refill_loop, name='proxy-prewarm', daemon=True)
+        self.thread.start()
+
+    def get_proxy(self, ip, port):
+        key = (ip, port)
+        with self.lock:
+            if key not in self.proxies:
+                self.proxies[key] = {'sessions': deque(), 'in_use': 0, 'used': 0, 'lock': threading.Lock(),
+                                     'failed_until': 0}
+            return self.proxies[key]
+
+    def prewarm(self, ip, port):
+        """Ask for warm sessions through proxy (call as soon as proxy is known)"""
+        self.get_proxy(ip, port)['used'] = time.time()
+        self.wakeup.set()
+
+    def acquire(self, ip, port):
+        """Return warm session for proxy, or a new (cold) one if none ready"""
+        proxy = self.get_proxy(ip, port)
+        proxy['used'] = time.time()
+        with proxy['lock']:
+            # session in use comes back by release(), no need to open new one instead of it
+            proxy['in_use'] += 1
+            while proxy['sessions']:
+                created, session = proxy['sessions'].popleft()
+                if time.time() - created < self.max_idle:
+                    self.stats['warm'] += 1
+                    return session
+                session.close()
+                self.stats['dropped'] += 1
+        self.stats['cold'] += 1
+        return requests.Session()
+
+    def release(self, ip, port, session, reusable=True):
+        """Give session back after fetch, its connection is still warm if reusable"""
+        proxy = self.get_proxy(ip, port)
+        with proxy['lock']:
+            proxy['in_use'] -= 1
+            if reusable and len(proxy['sessions']) < self.warm_per_proxy:
+                proxy['sessions'].append((time.time(), session))
+                return
+        session.close()
+
+    def open_session(self, ip, port):
+        if port != -1:
+            socks.setthreadproxy(socks.PROXY_TYPE_SOCKS5, ip, port)
+        else:
+            socks.setthreadproxy()
+        session = requests.Session()
+        try:
+            session.head(warm_url, headers=self.headers, timeout=self.timeout, allow_redirects=False)
+        except (requests.exceptions.RequestException, socket.timeout, socks.ProxyError):
+            session.close()
+            self.log.debug('prewarm failed, proxy %s:%s' % (ip, port), exc_info=True)
+            return None
+        finally:
+            socks.setthreadproxy()
+        return session
+
+    def refill_loop(self):
+        while not self.stopped:
+            self.wakeup.wait(1)
+            self.wakeup.clear()
+            now = time.time()
+            with self.lock:
+                recent = sorted(self.proxies.items(), key=lambda item: item[1]['used'], reverse=True)
+            for number, ((ip, port), proxy) in enumerate(recent):
+                with proxy['lock']:
+                    # drop stale sessions and everything of proxies not used for a long time
+                    wanted = number < self.max_proxies and now - proxy['used'] < self.max_idle
+                    keep = deque((created, session) for created, session in proxy['sessions']
+                                 if wanted and now - created < self.max_idle)
+                    for created, session in proxy['sessions']:
+                        if (created, session) not in keep:
+                            session.close()
+                            self.stats['dropped'] += 1
+                    proxy['sessions'] = keep
+                    missing = self.warm_per_proxy - len(keep) - proxy['in_use'] if wanted else 0
+                if missing <= 0 or now < proxy['failed_until'] or self.stopped:
+                    continue
+                for i in range(missing):
+                    session = self.open_session(ip, port)
+                    if not session:
+                        self.stats['failed'] += 1
+                        proxy['failed_until'] = time.time() + self.max_idle
+                        break
+                    self.stats['opened'] += 1
+                    with proxy['lock']:
+                        proxy['sessions'].append((time.time(), session))
+
+    def close(self):
+        self.stopped = True
+        self.wakeup.set()
+        with self.lock:
+            proxies = list(self.proxies.values())
+        for proxy in proxies:
+            with proxy['lock']:
+                for created, session in proxy['sessions']:
+                    session.close()
+                proxy['sessions'].clear()
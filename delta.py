@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""Delta between two snapshots of the catalog, for updating viewer installs.
+
+Snapshot is a folder with rows (catalog.db, table.bin/table.txt or
+table_sorted.txt of sort.py) and optionally descr/descr.db. Rows are
+compared by id and a digest of the record, descriptions by id and the
+digests of their chunks in the store, so nothing is decompressed.
+
+Delta package is a tar with meta.json, rows.bz2 (added and changed
+records), removed.bz2 (ids), descr.bz2 (added and changed descriptions)
+and descr_removed.bz2 (ids).
+
+Snapshot is identified by fingerprint - sum of digests of all rows, it is
+kept in meta of catalog.db of the install. Delta is applied only to the
+snapshot it was made from, in order:
+  1. new and changed descriptions (one transaction of descr.db)
+  2. rows and new fingerprint (one transaction of catalog.db) - the switch
+  3. descriptions of removed rows (one transaction of descr.db)
+so the viewer never sees a row without its description. Interrupted apply
+is completed by running it again.
+
+Usage (standalone):
+    python3 ./delta.py diff old_folder new_folder update.delta
+    python3 ./delta.py apply update.delta [next.delta ...]    # in viewer folder
+    python3 ./delta.py info update.delta
+    python3 ./delta.py fingerprint [folder]
+"""
+
+import argparse
+import bz2
+import hashlib
+import io
+import json
+import os
+import struct
+import tarfile
+import tempfile
+
+import catalog
+import descrstore
+import record
+
+descr_folder = 'descr'
+fingerprint_key = 'snapshot'
+fingerprint_mask = (1 << 128) - 1
+descr_header = struct.Struct('<II')  # id, length of utf8 text
+
+
+def row_digest(row):
+    return int.from_bytes(hashlib.blake2b(row.pack(), digest_size=16).digest(), 'little')
+
+
+def fingerprint(digests):
+    # sum doesn't depend on order of rows
+    return '%032x' % (sum(digests) & fingerprint_mask)
+
+
+def snapshot_records(folder):
+    """Yield records of snapshot, one per id"""
+    catalog_path = os.path.join(folder, catalog.catalog_file)
+    if os.path.isfile(catalog_path):
+        source = catalog.Catalog(catalog_path, readonly=True)
+        try:
+            yield from source.records()
+        finally:
+            source.close()
+        return
+    if os.path.isfile(os.path.join(folder, 'table_sorted.txt')):
+        # already one row per id (sort.py)
+        yield from record.read_table(os.path.join(folder, 'table_sorted.txt'))
+        return
+    records = {}
+    for name in ('table.txt', 'table.bin'):
+        if os.path.isfile(os.path.join(folder, name)):
+            for row in record.read_table(os.path.join(folder, name)):
+                records[row.id] = row
+    # no table - empty snapshot (delta from it is a full install)
+    yield from records.values()
+
+
+def snapshot_store(folder):
+    return descrstore.open_store(os.path.join(folder, descr_folder))
+
+
+def snapshot_fingerprint(folder):
+    return fingerprint(row_digest(row) for row in snapshot_records(folder))
+
+
+class _Member:
+    """bz2 compressed member of package, spooled to temporary file"""
+
+    def __init__(self, name):
+        self.name = name
+        self.file = tempfile.TemporaryFile()
+        self.stream = bz2.BZ2File(self.file, 'wb')
+        self.count = 0
+
+    def add_to(self, archive):
+        self.stream.close()
+        info = tarfile.TarInfo(self.name)
+        info.size = self.file.tell()
+        self.file.seek(0)
+        archive.addfile(info, self.file)
+        self.file.close()
+
+
+def _add_json(archive, name, data):
+    body = json.dumps(data, indent=1).encode()
+    info = tarfile.TarInfo(name)
+    info.size = len(body)
+    archive.addfile(info, io.BytesIO(body))
+
+
+def diff(old_folder, new_folder, filename):
+    """Write delta package from old to new snapshot, return its meta"""
+    old_digests = dict((row.id, row_digest(row)) for row in snapshot_records(old_folder))
+    old_fingerprint = fingerprint(old_digests.values())
+
+    rows = _Member('rows.bz2')
+    new_digests = []
+    for row in snapshot_records(new_folder):
+        digest = row_digest(row)
+        new_digests.append(digest)
+        if old_digests.pop(row.id, None) != digest:
+            rows.stream.write(row.pack())
+            rows.count += 1
+    removed = _Member('removed.bz2')
+    for id in sorted(old_digests):
+        removed.stream.write(b'%i\n' % id)
+        removed.count += 1
+    del old_digests
+
+    members = [rows, removed]
+    new_store = snapshot_store(new_folder)
+    if new_store:
+        old_store = snapshot_store(old_folder)
+        old_descriptions = dict(old_store.digests()) if old_store else {}
+        descriptions = _Member('descr.bz2')
+        for id, digests in new_store.digests():
+            if old_descriptions.pop(id, None) != digests:
+                data = new_store.get(id).encode('utf8')
+                descriptions.stream.write(descr_header.pack(id, len(data)) + data)
+                descriptions.count += 1
+        descriptions_removed = _Member('descr_removed.bz2')
+        for id in sorted(old_descriptions):
+            descriptions_removed.stream.write(b'%i\n' % id)
+            descriptions_removed.count += 1
+        members.extend((descriptions, descriptions_removed))
+        new_store.close()
+        if old_store:
+            old_store.close()
+
+    meta = {'from': old_fingerprint, 'to': fingerprint(new_digests)}
+    for member in members:
+        meta[member.name.split('.')[0]] = member.count
+    with tarfile.open(filename + '.tmp', 'w') as archive:
+        _add_json(archive, 'meta.json', meta)
+        for member in members:
+            member.add_to(archive)
+    os.replace(filename + '.tmp', filename)
+    return meta
+
+
+def read_meta(archive):
+    return json.load(archive.extractfile('meta.json'))
+
+
+def _member(archive, name):
+    try:
+        return bz2.BZ2File(archive.extractfile(name))
+    except KeyError:
+        return None
+
+
+def _ids(stream):
+    return [int(line) for line in stream] if stream else []
+
+
+def _descriptions(stream):
+    while True:
+        head = stream.read(descr_header.size)
+        if not head:
+            return
+        id, length = descr_header.unpack(head)
+        yield id, stream.read(length).decode('utf8')
+
+
+def apply(filename, folder='.'):
+    """Apply delta package to viewer install in folder, return its meta"""
+    with tarfile.open(filename, 'r') as archive:
+        meta = read_meta(archive)
+        catalog_path = os.path.join(folder, catalog.catalog_file)
+        if not os.path.isfile(catalog_path) and meta['from'] != fingerprint([]):
+            raise ValueError('%s is made for snapshot %s, there is no %s' % (filename, meta['from'], catalog_path))
+        target = catalog.Catalog(catalog_path)
+        try:
+            current = target.get_meta(fingerprint_key)
+            if current is None:
+                # install made before deltas, fingerprint is counted once
+                current = fingerprint(row_digest(row) for row in target.records())
+            if current not in (meta['from'], meta['to']):
+                raise ValueError('%s is made for snapshot %s, install is %s' % (filename, meta['from'], current))
+
+            descriptions = _member(archive, 'descr.bz2')
+            store = None
+            if descriptions:
+                store = descrstore.open_store(os.path.join(folder, descr_folder), readonly=False)
+            if current != meta['to']:
+                if store:
+                    store.put_many(_descriptions(descriptions))
+                target.apply_changes(record.read_records(_member(archive, 'rows.bz2')),
+                                     _ids(_member(archive, 'removed.bz2')), {fingerprint_key: meta['to']})
+            # removed last, also when previous apply stopped after the switch
+            if store:
+                store.delete_many(_ids(_member(archive, 'descr_removed.bz2')))
+                store.close()
+        finally:
+            target.close()
+    return meta
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='delta between snapshots of catalog')
+    ap.add_argument('command', choices=('diff', 'apply', 'info', 'fingerprint'))
+    ap.add_argument('paths', nargs='*')
+    ap.add_argument('--folder', default='.', help='viewer install for apply')
+    options = ap.parse_args()
+
+    if options.command == 'diff':
+        if len(options.paths) != 3:
+            ap.exit(1, 'diff old_folder new_folder update.delta\n')
+        meta = diff(*options.paths)
+        print(json.dumps(meta))
+        print('%s: %i bytes' % (options.paths[2], os.path.getsize(options.paths[2])))
+    elif options.command == 'apply':
+        for path in options.paths:
+            try:
+                meta = apply(path, options.folder)
+            except ValueError as e:
+                ap.exit(1, '%s\n' % e)
+            print('%s applied, snapshot %s' % (path, meta['to']))
+    elif options.command == 'info':
+        for path in options.paths:
+            with tarfile.open(path, 'r') as archive:
+                print('%s: %s' % (path, json.dumps(read_meta(archive))))
+    else:
+        print(snapshot_fingerprint(options.paths[0] if options.paths else '.'))
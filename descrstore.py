@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+"""Deduplicated store of descriptions.
+
+Description is split into content-defined chunks: a chunk ends before a
+'<' whose preceding bytes hash to a value with low bits zero, so an
+identical block of markup (repacks, episodes of a series) gives identical
+chunks wherever it is in the page. Chunks are kept once, by sha1, with a
+count of descriptions referring to them. Everything is in one sqlite file.
+
+Each chunk is compressed on its own, after 'train' with a dictionary
+trained on chunks of the store (see codec.py) and kept in the same file.
+Every train increments codec generation in meta, connections opened
+before it (loader --dedup, viewer) reload the codec when they see a new
+generation at the start of their next transaction.
+
+Usage (standalone):
+    python3 ./descrstore.py import descr     # loose files and tar buckets of descr/ into descr/descr.db
+    python3 ./descrstore.py train descr      # (re)compress all chunks with trained dictionary
+    python3 ./descrstore.py train descr --codec zstd-dict    # viewers need zstandard module
+    python3 ./descrstore.py stats descr
+    python3 ./descrstore.py get descr 1234567
+"""
+
+import argparse
+import contextlib
+import hashlib
+import os
+import random
+import sqlite3
+import tarfile
+import zlib
+
+import codec
+
+store_filename = 'descr.db'
+digest_size = 20
+
+min_chunk = 256
+max_chunk = 8192
+boundary_mask = 0x1f  # cut at about every 32th candidate
+boundary_window = 32
+
+
+def split_chunks(data):
+    chunks = []
+    start = 0
+    pos = data.find(b'<', start + min_chunk)
+    while pos != -1:
+        if pos - start > max_chunk:
+            # no boundary in time
+            chunks.append(data[start:start + max_chunk])
+            start += max_chunk
+            pos = data.find(b'<', start + min_chunk)
+        elif zlib.crc32(data[pos - boundary_window:pos]) & boundary_mask == 0:
+            chunks.append(data[start:pos])
+            start = pos
+            pos = data.find(b'<', start + min_chunk)
+        else:
+            pos = data.find(b'<', pos + 1)
+    while len(data) - start > max_chunk:
+        chunks.append(data[start:start + max_chunk])
+        start += max_chunk
+    if start < len(data) or not chunks:
+        chunks.append(data[start:])
+    return chunks
+
+
+class DescriptionStore:
+    def __init__(self, filename, readonly=False):
+        self.filename = filename
+        if readonly:
+            self.db = sqlite3.connect('file:%s?mode=ro' % filename, uri=True)
+        else:
+            self.db = sqlite3.connect(filename)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS chunks (digest BLOB PRIMARY KEY, data BLOB, refs INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, digests BLOB)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)')
+            self.db.commit()
+        self.generation = None
+        self.codec = None
+        self.check_codec()
+
+    def load_codec(self):
+        try:
+            meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        except sqlite3.OperationalError:
+            meta = {}  # store made before codecs
+        self.generation = meta.get('generation', 0)
+        self.codec = codec.Codec(meta.get('codec', 'zlib'), meta.get('dictionary', b''))
+
+    def check_codec(self):
+        """Reload codec if the store was trained by another connection since it was loaded"""
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        if self.codec is None or (row[0] if row else 0) != self.generation:
+            self.load_codec()
+
+    @contextlib.contextmanager
+    def transaction(self, write=True):
+        # write lock is taken before the codec is checked, so train can't commit in between
+        self.db.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+        try:
+            self.check_codec()
+            yield
+        except BaseException:
+            self.db.rollback()
+            raise
+        self.db.commit()
+
+    def compress(self, data):
+        return self.codec.compress(data)
+
+    def decompress(self, data):
+        return self.codec.decompress(data)
+
+    def _add_chunks(self, chunks):
+        digests = []
+        for chunk in chunks:
+            digest = hashlib.sha1(chunk).digest()
+            if self.db.execute('UPDATE chunks SET refs = refs + 1 WHERE digest = ?', (digest,)).rowcount == 0:
+                self.db.execute('INSERT INTO chunks VALUES (?, ?, 1)', (digest, self.compress(chunk)))
+            digests.append(digest)
+        return b''.join(digests)
+
+    def _release_chunks(self, digests):
+        for i in range(0, len(digests), digest_size):
+            digest = digests[i:i + digest_size]
+            self.db.execute('UPDATE chunks SET refs = refs - 1 WHERE digest = ?', (digest,))
+            self.db.execute('DELETE FROM chunks WHERE digest = ? AND refs <= 0', (digest,))
+
+    def _put(self, id, text):
+        digests = self._add_chunks(split_chunks(text.encode('utf8')))
+        row = self.db.execute('SELECT digests FROM records WHERE id = ?', (id,)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?)', (id, digests))
+        # after adding, so chunks shared by old and new text survive
+        if row:
+            self._release_chunks(row[0])
+
+    def _delete(self, id):
+        row = self.db.execute('SELECT digests FROM records WHERE id = ?', (id,)).fetchone()
+        if row:
+            self.db.execute('DELETE FROM records WHERE id = ?', (id,))
+            self._release_chunks(row[0])
+
+    def put(self, id, text):
+        """Store description of id (replaces previous one)"""
+        with self.transaction():
+            self._put(id, text)
+
+    def delete(self, id):
+        with self.transaction():
+            self._delete(id)
+
+    def put_many(self, descriptions):
+        """Store (id, text) pairs in one transaction"""
+        with self.transaction():
+            for id, text in descriptions:
+                self._put(id, text)
+
+    def delete_many(self, ids):
+        with self.transaction():
+            for id in ids:
+                self._delete(id)
+
+    def digests(self):
+        """Yield (id, digests of chunks), equal digests - equal descriptions"""
+        yield from self.db.execute('SELECT id, digests FROM records')
+
+    def get(self, id):
+        """Description of id or None"""
+        with self.transaction(write=False):
+            row = self.db.execute('SELECT digests FROM records WHERE id = ?', (id,)).fetchone()
+            if not row:
+                return None
+            data = bytearray()
+            for i in range(0, len(row[0]), digest_size):
+                chunk = self.db.execute('SELECT data FROM chunks WHERE digest = ?', (row[0][i:i + digest_size],)).fetchone()
+                data += self.decompress(chunk[0])
+        return data.decode('utf8')
+
+    def __contains__(self, id):
+        return self.db.execute('SELECT 1 FROM records WHERE id = ?', (id,)).fetchone() is not None
+
+    def ids(self):
+        return [row[0] for row in self.db.execute('SELECT id FROM records ORDER BY id')]
+
+    def stats(self):
+        records, references = self.db.execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(digests)), 0) FROM records').fetchone()
+        chunks, stored, refs = self.db.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0), COALESCE(SUM(refs), 0) FROM chunks').fetchone()
+        return {'records': records, 'chunks': chunks, 'references': references // digest_size, 'stored_bytes': stored,
+                'shared_references': refs - chunks}
+
+    def train(self, sample_count=5000, size=None, codec_name='zlib-dict'):
+        """Train dictionary on random chunks and recompress all chunks with it"""
+        samples = []
+        with self.transaction(write=False):
+            digests = [row[0] for row in self.db.execute('SELECT digest FROM chunks')]
+            for digest in random.sample(digests, min(sample_count, len(digests))):
+                samples.append(self.decompress(self.db.execute('SELECT data FROM chunks WHERE digest = ?', (digest,)).fetchone()[0]))
+        new_codec = codec.train(samples, size, codec_name)
+        with self.transaction():
+            # chunks added by a writer since sampling are recompressed too
+            for (digest,) in self.db.execute('SELECT digest FROM chunks').fetchall():
+                data = self.decompress(self.db.execute('SELECT data FROM chunks WHERE digest = ?', (digest,)).fetchone()[0])
+                self.db.execute('UPDATE chunks SET data = ? WHERE digest = ?', (new_codec.compress(data), digest))
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('codec', new_codec.name))
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('dictionary', new_codec.dictionary))
+            self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('generation', self.generation + 1))
+        self.codec = new_codec
+        self.generation += 1
+
+    def compact(self):
+        self.db.execute('VACUUM')
+
+    def close(self):
+        self.db.close()
+
+
+def open_store(folder, readonly=True):
+    """Store in descriptions folder or None if there is no store there"""
+    filename = os.path.join(folder, store_filename)
+    if readonly and not os.path.isfile(filename):
+        return None
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    return DescriptionStore(filename, readonly)
+
+
+def import_folder(store, folder):
+    """Import loose description files (NNN/NNNNNNNN) and tar buckets (NNN/NNNNN.tar.bz2)"""
+    count = 0
+    for subfolder in sorted(os.listdir(folder)):
+        path = os.path.join(folder, subfolder)
+        if not (os.path.isdir(path) and subfolder.isdigit()):
+            continue
+        for name in sorted(os.listdir(path)):
+            if name.isdigit():
+                store.put(int(name), open(os.path.join(path, name), encoding='utf8').read())
+                count += 1
+            elif name.endswith('.tar.bz2'):
+                with tarfile.open(os.path.join(path, name), 'r:bz2') as archive:
+                    for member in archive:
+                        if member.isfile() and os.path.basename(member.name).isdigit():
+                            store.put(int(os.path.basename(member.name)), archive.extractfile(member).read().decode())
+                            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='deduplicated store of descriptions')
+    ap.add_argument('command', choices=('import', 'train', 'stats', 'get', 'compact'))
+    ap.add_argument('folder', nargs='?', default='descr')
+    ap.add_argument('id', nargs='?', type=int)
+    ap.add_argument('--codec', choices=('zlib-dict', 'zstd-dict'), default='zlib-dict',
+                    help='for train, zstd-dict can be read only with zstandard module')
+    options = ap.parse_args()
+
+    store = open_store(options.folder, readonly=options.command in ('stats', 'get'))
+    if store is None:
+        ap.exit(1, 'no %s in %s\n' % (store_filename, options.folder))
+    if options.command == 'import':
+        print('imported: %i' % import_folder(store, options.folder))
+        store.compact()
+    elif options.command == 'train':
+        if options.codec == 'zstd-dict' and codec.zstandard is None:
+            ap.exit(1, 'zstd-dict codec needs zstandard module (pip install zstandard)\n')
+        store.train(codec_name=options.codec)
+        store.compact()
+        print('codec: %s, dictionary: %i bytes' % (store.codec.name, len(store.codec.dictionary)))
+    elif options.command == 'compact':
+        store.compact()
+    elif options.command == 'get':
+        text = store.get(options.id)
+        if text is None:
+            ap.exit(1, 'no description for %i\n' % options.id)
+        print(text)
+    if options.command != 'get':
+        for key, value in store.stats().items():
+            print('%-18s %i' % (key, value))
+    store.close()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+"""Count of tasks in flight (given to workers, proxy and cookie leased) by Little's law.
+
+Tasks in flight are the ones being processed by workers plus the ones
+waiting in the queue. The queue only has to cover the time between a
+worker finishing a task and the coordinator handing out the next one,
+every task waiting longer holds its proxy and cookie for nothing.
+
+A worker finishes 1/S tasks per second (S - measured service time, from
+start of task in worker to its result in coordinator), so for workers to
+find a task every time while tasks wait in the queue target_wait seconds:
+    limit = workers + workers * target_wait / S
+target_wait is adapted to measurements: it grows when workers waited for
+a task while the limit held tasks back (queue ran empty, not proxies or
+cookies) and slowly shrinks while workers find tasks at once. The queue
+part is at most --qsize, or the count of workers without it.
+"""
+
+import math
+
+
+def ewma(average, value, alpha):
+    return value if average is None else average + alpha * (value - average)
+
+
+class InFlightLimit:
+    alpha = 0.1  # weight of the newest measurement
+    min_wait = 0.02
+    max_wait = 10.0
+
+    def __init__(self, max_queue=None, target_wait=0.1):
+        self.max_queue = max_queue  # --qsize, upper bound of the queue part
+        self.target_wait = target_wait
+        self.service = None  # seconds, averages of measurements
+        self.queue_wait = None
+        self.idle = None
+
+    def update(self, details, now, at_limit=True):
+        """Measurements of finished task: 'dispatched' (coordinator), 'started' and 'idle' (worker).
+
+        at_limit - last dispatch stopped at the limit (not for lack of proxy, cookie or ids)
+        """
+        started = details.get('started')
+        if started is None:
+            return
+        self.service = ewma(self.service, max(0.0, now - started), self.alpha)
+        if details.get('dispatched') is not None:
+            self.queue_wait = ewma(self.queue_wait, max(0.0, started - details['dispatched']), self.alpha)
+        if details.get('idle') is not None:
+            self.idle = ewma(self.idle, details['idle'], self.alpha)
+        starving = self.idle is not None and self.idle > 0.02 * self.service
+        if starving and at_limit:
+            self.target_wait = min(self.max_wait, self.target_wait * 1.1)
+        elif not starving:
+            # probe down while workers are busy, leases in queue are wasted
+            self.target_wait = max(self.min_wait, self.target_wait * 0.98)
+
+    def queue_size(self, workers):
+        if not self.service:
+            queue = 2  # nothing measured yet
+        else:
+            queue = math.ceil(workers * self.target_wait / self.service)
+        # without --qsize at most one queued task per worker, a bad measurement
+        # would otherwise lease every proxy and cookie
+        queue = min(queue, workers if self.max_queue is None else self.max_queue)
+        return max(1, queue)
+
+    def limit(self, workers):
+        return workers + self.queue_size(workers)
+
+    def status(self):
+        if self.service is None:
+            return 'not measured'
+        return 'service %.2fs, queue wait %.2fs (target %.2fs), worker idle %.2fs' % (
+            self.service, self.queue_wait or 0, self.target_wait, self.idle or 0)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+
+"""Index of infohashes of table.bin: lookup by hash and duplicate hashes.
+
+Hashes are kept as one sorted run of 20-byte values (hashes.idx) with
+id and offset of the record in table.bin for each, lookup is a binary
+search. Re-crawled ids keep their last record. Index remembers the size
+of table.bin it was built for and a digest of its last bytes; records
+appended after it are sorted and merged into the index, a table rewritten
+in between (different digest) is indexed again.
+
+File: header '<4sIQ16s' (magic, count, size of table.bin, digest of its
+last tail_size bytes), count hashes, count ids (uint32), count offsets (uint64).
+
+Usage (standalone):
+    python3 ./hashindex.py build                 # hashes.idx from table.bin
+    python3 ./hashindex.py lookup HASH|MAGNET
+    python3 ./hashindex.py duplicates            # hashes of more than one id
+"""
+
+import argparse
+import bisect
+import hashlib
+import os
+import re
+import struct
+import sys
+from array import array
+
+import record
+
+index_file = 'hashes.idx'
+table_file = 'table.bin'
+magic = b'RTH2'
+old_magic = b'RTHI'  # index without digest of table, is built again
+header = struct.Struct('<4sIQ16s')
+hash_size = 20
+tail_size = 4096
+
+
+def tail_digest(filename, end):
+    """Digest of bytes of file before end, changes when the file is rewritten"""
+    with open(filename, 'rb') as f:
+        f.seek(max(0, end - tail_size))
+        return hashlib.blake2b(f.read(end - max(0, end - tail_size)), digest_size=16).digest()
+
+
+def to_hash(text):
+    """20 bytes from hex or base32 hash, magnet link or bytes, ValueError if it is none of them"""
+    if isinstance(text, bytes):
+        return text
+    found = re.search(r'btih:([0-9A-Za-z]+)', text)
+    hash = record.hash_bytes(found.group(1) if found else text.strip())
+    if hash is None:
+        raise ValueError('not a hash or magnet link: %s' % text)
+    return hash
+
+
+class HashArray:
+    """Sequence of 20-byte hashes in one bytearray (no object per hash)"""
+
+    def __init__(self, data=b''):
+        self.data = bytearray(data)
+
+    def __len__(self):
+        return len(self.data) // hash_size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return bytes(self.data[i * hash_size:(i + 1) * hash_size])
+
+    def append(self, hash):
+        self.data += to_hash(hash)
+
+
+class HashIndex:
+    def __init__(self, filename=index_file, table=table_file):
+        self.filename = filename
+        self.table = table
+        self.clear()
+        if os.path.isfile(filename):
+            self.load()
+
+    def clear(self):
+        self.hashes = HashArray()
+        self.ids = array('I')
+        self.offsets = array('Q')
+        self.table_size = 0
+        self.table_digest = None
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            if f.read(len(old_magic)) == old_magic:
+                return
+            f.seek(0)
+            name, count, self.table_size, self.table_digest = header.unpack(f.read(header.size))
+            if name != magic:
+                raise ValueError('%s is not a hash index' % self.filename)
+            self.hashes = HashArray(f.read(count * hash_size))
+            self.ids = array('I')
+            self.ids.fromfile(f, count)
+            self.offsets = array('Q')
+            self.offsets.fromfile(f, count)
+
+    def save(self):
+        with open(self.filename + '.tmp', 'wb') as f:
+            f.write(header.pack(magic, len(self.ids), self.table_size, self.table_digest))
+            f.write(self.hashes.data)
+            self.ids.tofile(f)
+            self.offsets.tofile(f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def update(self):
+        """Add records appended to table since last update (all if table was rewritten), return their count"""
+        if not os.path.isfile(self.table):
+            return 0
+        size = os.path.getsize(self.table)
+        if size < self.table_size or tail_digest(self.table, self.table_size) != self.table_digest:
+            # table was rewritten (sort, repair, another crawl)
+            self.clear()
+        elif size == self.table_size:
+            return 0
+        entries = {}  # id -> (hash, offset) of new records, the last one of id wins
+        start = self.table_size
+        count = 0
+        with open(self.table, 'rb') as f:
+            f.seek(start)
+            offset = start
+            for row, end in record.iter_records(f):
+                entries[row.id] = (row.hash, offset)
+                offset = start + end
+                count += 1
+        # last record can be still incomplete (being written), it is read next time
+        self.table_size = offset
+        self.table_digest = tail_digest(self.table, offset)
+        if entries:
+            # re-crawled ids: their older records are superseded
+            self.remove([i for i, id in enumerate(self.ids) if id in entries])
+            self.insert(sorted((hash, id, offset) for id, (hash, offset) in entries.items()))
+        return count
+
+    def remove(self, positions):
+        """Drop entries at sorted positions, the rest is copied by slices"""
+        if not positions:
+            return
+        hashes = bytearray()
+        ids = array('I')
+        offsets = array('Q')
+        start = 0
+        for i in positions + [len(self.ids)]:
+            hashes += self.hashes.data[start * hash_size:i * hash_size]
+            ids += self.ids[start:i]
+            offsets += self.offsets[start:i]
+            start = i + 1
+        self.hashes = HashArray(hashes)
+        self.ids = ids
+        self.offsets = offsets
+
+    def insert(self, entries):
+        """Merge sorted (hash, id, offset) entries into sorted index"""
+        hashes = bytearray()
+        ids = array('I')
+        offsets = array('Q')
+        start = 0
+        for hash, id, offset in entries:
+            i = bisect.bisect_left(self.hashes, hash, start)
+            while i < len(self.ids) and self.hashes[i] == hash and self.ids[i] < id:
+                i += 1
+            hashes += self.hashes.data[start * hash_size:i * hash_size]
+            ids += self.ids[start:i]
+            offsets += self.offsets[start:i]
+            hashes += hash
+            ids.append(id)
+            offsets.append(offset)
+            start = i
+        hashes += self.hashes.data[start * hash_size:]
+        ids += self.ids[start:]
+        offsets += self.offsets[start:]
+        self.hashes = HashArray(hashes)
+        self.ids = ids
+        self.offsets = offsets
+
+    def lookup(self, hash):
+        """Ids with hash (more than one for duplicates)"""
+        hash = to_hash(hash)
+        i = bisect.bisect_left(self.hashes, hash)
+        ids = []
+        while i < len(self.ids) and self.hashes[i] == hash:
+            ids.append(self.ids[i])
+            i += 1
+        return ids
+
+    def records(self, hash):
+        """Records of table with hash"""
+        hash = to_hash(hash)
+        rows = []
+        with open(self.table, 'rb') as f:
+            i = bisect.bisect_left(self.hashes, hash)
+            while i < len(self.ids) and self.hashes[i] == hash:
+                f.seek(self.offsets[i])
+                rows.append(next(record.read_records(f)))
+                i += 1
+        return rows
+
+    def __contains__(self, hash):
+        return bool(self.lookup(hash))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def duplicates(self):
+        """Yield (hash, ids) for hashes of more than one id"""
+        i = 0
+        while i < len(self.ids):
+            hash = self.hashes[i]
+            j = i + 1
+            while j < len(self.ids) and self.hashes[j] == hash:
+                j += 1
+            if j - i > 1:
+                yield hash, list(self.ids[i:j])
+            i = j
+
+
+def open_index(filename=index_file, table=table_file):
+    """Index updated to the current table"""
+    index = HashIndex(filename, table)
+    if index.update():
+        index.save()
+    return index
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='index of infohashes of table.bin')
+    ap.add_argument('command', choices=('build', 'lookup', 'duplicates'))
+    ap.add_argument('hash', nargs='?')
+    ap.add_argument('--table', default=table_file)
+    ap.add_argument('--index', default=index_file)
+    options = ap.parse_args()
+
+    hash = None
+    if options.command == 'lookup':
+        if not options.hash:
+            ap.exit(1, 'no hash\n')
+        try:
+            hash = to_hash(options.hash)
+        except ValueError as e:
+            ap.error(str(e))
+    index = open_index(options.index, options.table)
+    if options.command == 'build':
+        print('%i hashes' % len(index))
+    elif options.command == 'lookup':
+        rows = index.records(hash)
+        for row in rows:
+            print(row.to_line())
+        sys.exit(0 if rows else 1)
+    else:
+        for hash, ids in index.duplicates():
+            print('%s  %s' % (hash.hex().upper(), ' '.join(map(str, ids))))
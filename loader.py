@@ -3,33 +3,455 @@
 import os
 from settings import Settings
 import parse
+import connpool
+import flowcontrol
+import profiling
 import random
-from multiprocessing import Queue, freeze_support, Process, current_process
+from multiprocessing import Queue, Value, freeze_support, Process, current_process
+from multiprocessing.connection import wait
 import queue # for exceptions
+import threading
 import logging
 import time
 import requests
 import signal
 
-def worker(input, output):
+page_delay = 3  # seconds before each page request
+
+def next_task(input, current=None):
+    with profiling.stage('wait task'):
+        task = input.get()
+        if current is not None:
+            # shared with coordinator, set as soon as the task is off the queue, so the
+            # task of a worker dying at any later point is known (see Coordinator.lost_task)
+            current.value = task[1].get('task', 0)
+    return task
+
+def spool_description(details, folder, spool_above):
+    """Write description longer than spool_above bytes to spool folder, result carries file name instead of text"""
+    data = details['description'].encode('utf8')
+    if len(data) <= spool_above:
+        return
+    filename = os.path.join(folder, '%08i' % details['id'])
+    with open(filename, 'wb') as f:
+        f.write(data)
+    details['description'] = None
+    details['description_file'] = filename
+
+def worker(input, output, warm_connections=0, manager=None, profile_folder=None, spool_folder=None, spool_above=0,
+           current=None):
+    if threading.current_thread() is threading.main_thread():
+        # Ctrl+C is handled by coordinator, it stops workers after in-flight pages are saved
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if profile_folder:
+        profiling.start(profile_folder, 'worker')
     try:
         log = logging.getLogger("thread(%3i)" % random.randrange(1, 999)) # random name
         log.debug('starting thread')
 
-        for new_input in iter(input.get, ('STOP',{})):
+        idle_since = None
+        for new_input in iter(lambda: next_task(input, current), ('STOP',{})):
             # log.debug('thread iteration')
+            # for flowcontrol: when task started, how long worker waited for it
+            new_input[1]['started'] = time.time()
+            if idle_since is not None:
+                new_input[1]['idle'] = new_input[1]['started'] - idle_since
             new_input[1]['logger'] = log
             if new_input[0] == 'COOKIE':
-                status, details = parse.get_cookie(new_input[1])
+                with profiling.stage('cookie'):
+                    status, details = parse.get_cookie(new_input[1])
                 output.put((new_input[0], status, details))
             elif new_input[0] == 'GET_PAGE':
-                time.sleep(3)
-                status, details = parse.get_page(new_input[1])
+                if warm_connections and not manager:
+                    manager = connpool.ProxyConnectionManager(new_input[1]['headers'], warm_per_proxy=warm_connections)
+                if manager:
+                    # connection to the proxy is opened while we are sleeping
+                    proxy_ip, proxy_port = new_input[1]['proxy_ip'], new_input[1]['proxy_port']
+                    manager.prewarm(proxy_ip, proxy_port)
+                    with profiling.stage('sleep'):
+                        time.sleep(page_delay)
+                    with profiling.stage('proxy'):
+                        session = manager.acquire(proxy_ip, proxy_port)
+                    new_input[1]['session'] = session
+                    with profiling.stage('page'):
+                        status, details = parse.get_page(new_input[1])
+                    reusable = (status != 'ERROR') or (details['text'] == 'not logined')
+                    manager.release(proxy_ip, proxy_port, session, reusable)
+                else:
+                    with profiling.stage('sleep'):
+                        time.sleep(page_delay)
+                    with profiling.stage('page'):
+                        status, details = parse.get_page(new_input[1])
+                if status == 'OK' and spool_folder:
+                    # big descriptions don't travel through done_queue and coordinator memory
+                    with profiling.stage('spool'):
+                        spool_description(details, spool_folder, spool_above)
                 output.put((new_input[0], status, details))
             else:
                 log.warning('unknown task: %s' % new_input[0])
+            if current is not None:
+                current.value = 0
+            idle_since = time.time()
     except KeyboardInterrupt:
         pass
+    finally:
+        if profile_folder:
+            profiling.stop()
+
+def thread_worker(input, output, warm_connections=0, manager=None, spool_folder=None, spool_above=0, current=None):
+    # thread has no sentinel like process, coordinator learns about its end by message
+    try:
+        worker(input, output, warm_connections, manager, None, spool_folder, spool_above, current)
+    finally:
+        output.put(('EXIT', threading.current_thread().name, {}))
+
+def start_workers(settings):
+    """Start workers as processes or threads (--workers), return (task_queue, done_queue, workers)
+
+    worker.current - shared number of task the worker is processing (0 - none)
+    """
+    workers = list()
+    if settings.workers_mode == 'thread':
+        # one process: proxy/cookie pools, writer and warm connections are shared
+        task_queue = queue.Queue()
+        done_queue = queue.Queue()
+        manager = None
+        if settings.warm_connections:
+            manager = connpool.ProxyConnectionManager(settings.headers, warm_per_proxy=settings.warm_connections,
+                                                      max_proxies=max(4, settings.threads_num))
+        for i in range(settings.threads_num):
+            current = Value('q', 0, lock=False)
+            t = threading.Thread(target=thread_worker, args=(task_queue, done_queue, settings.warm_connections, manager,
+                                                             settings.spool_folder, settings.spool_above, current),
+                                 name='worker-%i' % i, daemon=True)
+            t.current = current
+            t.start()
+            workers.append(t)
+    else:
+        task_queue = Queue()
+        done_queue = Queue()
+        for i in range(settings.threads_num):
+            current = Value('q', 0, lock=False)
+            p = Process(target=worker, args=(task_queue, done_queue, settings.warm_connections, None,
+                                             settings.profile_folder, settings.spool_folder, settings.spool_above,
+                                             current))
+            p.current = current
+            p.start()
+            workers.append(p)
+    return task_queue, done_queue, workers
+
+def queue_reader(q):
+    # multiprocessing.Queue has no public handle to wait on; its _reader (pipe end)
+    # is readable when results are waiting, so it is waited on with worker sentinels
+    return q._reader
+
+class Coordinator:
+    """Gives tasks to workers and saves their results.
+
+    Sleeps only in wait() for the first of: a result, death of a worker or
+    the next timer (status line, proxy/cookie housekeeping), so new tasks
+    go out as soon as a result frees proxy and cookie.
+    """
+    housekeeping_interval = 1
+    idle_timeout = 60  # exit if nothing can be started (no free proxy/cookie) for so long
+
+    def __init__(self, settings, task_queue, done_queue, processes):
+        self.log = logging.getLogger('coordinator')
+        self.settings = settings
+        self.task_queue = task_queue
+        self.done_queue = done_queue
+        self.processes = processes
+        self.ids_pointer = 0
+        self.in_flight = 0
+        self.tasks = {}  # task number: task given to workers, until its result comes
+        self.task_number = 0
+        self.stopping = False
+        self.nexttime = time.time()
+        self.status_nexttime = time.time() + 10
+        self.housekeeping_nexttime = time.time()
+        self.idle_since = None
+        self.flow = flowcontrol.InFlightLimit(settings.qsize)
+        self.at_limit = False  # last dispatch was stopped by self.flow
+        self.max_in_flight = 0  # limit of last dispatch
+        self.ids_status = {'finished_all':0, 'error_all':0, 'nohash_all':0,'finished_last':0, 'error_last':0, 'nohash_last':0}
+
+    def put(self, work):
+        self.task_number += 1
+        work[1]['task'] = self.task_number
+        self.tasks[self.task_number] = work
+        self.task_queue.put(work)
+        self.in_flight += 1
+
+    def refresh_cookies(self):
+        # new cookies are requested in background, old ones stay in use meanwhile
+        for login in self.settings.logins_to_refresh():
+            proxy = self.settings.get_free_proxy()
+            if not proxy:
+                self.settings.set_cookie_refresh_error(login['username'])
+                continue
+            self.put(('COOKIE', {'username': login['username'], 'password': login['password'],
+                                 'proxy_ip': proxy['ip'], 'proxy_port': int(proxy['port'])}))
+
+    def dispatch(self):
+        settings = self.settings
+        # workers beyond free proxies and cookies wouldn't get a task anyway
+        max_in_flight = self.max_in_flight = self.flow.limit(max(1, min(len(self.processes), settings.lease_capacity())))
+        self.at_limit = False
+        while (self.ids_pointer < len(settings.ids)) and not self.stopping:
+            if self.in_flight >= settings.max_results_in_flight:
+                # every result may bring up to spool_above bytes of description, keep them within --result_budget
+                break
+            if self.in_flight >= max_in_flight:
+                self.at_limit = True
+                break
+            proxy = settings.get_free_proxy()
+            if not proxy:
+                if time.time() > self.nexttime:
+                    self.log.info('free proxy not available')
+                    self.log.debug('proxies: %s' % str(settings.proxy_list))
+                    self.nexttime = time.time() + 60
+                break
+            cookie = settings.get_free_cookie()
+            if not cookie:
+                settings.set_free_proxy(proxy['ip'], proxy['port'])
+                if time.time() > self.nexttime:
+                    self.log.info('free cookie not available')
+                    self.log.debug('cookies: %s' % str(settings.login_list))
+                    self.nexttime = time.time() + 60
+                break
+            work = ('GET_PAGE', {'id': int(settings.ids[self.ids_pointer]), 'cookie': cookie, 'headers': dict(settings.headers), 'proxy_ip': proxy['ip'], 'proxy_port': int(proxy['port']), 'dispatched': time.time()})
+            self.put(work)
+            self.ids_pointer += 1
+
+    def print_status(self):
+        ids_status = self.ids_status
+        speed = (ids_status['finished_last'] + ids_status['nohash_last']) / 10.0
+        left = len(self.settings.ids) - self.ids_pointer
+        if speed != 0:
+            time_remaining = left / speed
+        else:
+            time_remaining = 0
+        m, s = divmod(time_remaining, 60)
+        h, m = divmod(m, 60)
+        print('Last 10 sec: %3d - OK, %3d - NOHASH, %2d - ERROR, Remaining: %ik, %d:%02d"' % (ids_status['finished_last'], ids_status['nohash_last'],
+                                                                                        ids_status['error_last'], left//1000,h,m))
+        ids_status['finished_all'] += ids_status['finished_last']
+        ids_status['error_all'] += ids_status['error_last']
+        ids_status['nohash_all'] += ids_status['nohash_last']
+        ids_status['finished_last'] = 0
+        ids_status['error_last'] = 0
+        ids_status['nohash_last'] = 0
+        self.log.debug('in flight: %i of %i, %s' % (self.in_flight, self.max_in_flight,
+                                                  self.flow.status()))
+
+    def run_timers(self):
+        now = time.time()
+        if now >= self.status_nexttime:
+            self.status_nexttime = now + 10
+            self.print_status()
+        if now >= self.housekeeping_nexttime:
+            self.housekeeping_nexttime = now + self.housekeeping_interval
+            self.settings.check_proxies()
+            if not self.stopping:
+                self.refresh_cookies()
+            self.settings.flush_cookies()
+            self.settings.flush_files()
+
+    def wait(self):
+        """Wait for results, worker death or next timer. Returns list of results."""
+        timeout = max(0, min(self.status_nexttime, self.housekeeping_nexttime) - time.time())
+        if isinstance(self.done_queue, queue.Queue):
+            return self.wait_threads(timeout)
+        ready = wait([queue_reader(self.done_queue)] + [p.sentinel for p in self.processes], timeout)
+        died = [p for p in self.processes if p.sentinel in ready]
+        results = []
+        while True:
+            try:
+                results.append(self.done_queue.get_nowait())
+            except queue.Empty:
+                break
+        for p in died:
+            p.join()  # exited already, for exitcode
+            self.log.error('thread %s died (exit code %s)' % (p.name, p.exitcode))
+            self.processes.remove(p)
+            results += self.lost_task(p, results)
+        return results
+
+    def wait_threads(self, timeout):
+        results = []
+        try:
+            results.append(self.done_queue.get(timeout=timeout))
+            while True:
+                results.append(self.done_queue.get_nowait())
+        except queue.Empty:
+            pass
+        for result in [result for result in results if result[0] == 'EXIT']:
+            results.remove(result)
+            for t in [t for t in self.processes if t.name == result[1]]:
+                self.log.error('thread %s died' % t.name)
+                self.processes.remove(t)
+                results += self.lost_task(t, results)
+        return results
+
+    def lost_task(self, worker, results):
+        """Error result for the task of dead worker, so its proxy and cookie are freed and id is queued again.
+
+        Empty if the worker had no task or its result came anyway.
+        """
+        number = worker.current.value
+        if number not in self.tasks or any(details.get('task') == number for _, _, details in results):
+            return []
+        task, details = self.tasks[number]
+        # started=None - not a measurement for self.flow
+        return [(task, 'ERROR', dict(details, text='worker %s died, id: %s' % (worker.name, details.get('id')),
+                                     started=None))]
+
+    def finished(self):
+        if self.in_flight:
+            self.idle_since = None
+            return False
+        if self.stopping or self.ids_pointer >= len(self.settings.ids):
+            self.log.info('All tasks done.')
+            return True
+        # ids left, but nothing can be started
+        if self.idle_since is None:
+            self.idle_since = time.time()
+        elif time.time() - self.idle_since > self.idle_timeout:
+            self.log.info('Nothing to do for %i sec (no free proxy or cookie), exit.' % self.idle_timeout)
+            return True
+        return False
+
+    def stop(self, signum=None, frame=None):
+        if self.stopping:
+            # second Ctrl+C - don't wait for workers
+            raise KeyboardInterrupt()
+        self.log.info('Ctrl+^C, finishing %i tasks in progress (press again to exit now)...' % self.in_flight)
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        self.refresh_cookies()
+        while True:
+            with profiling.stage('timers'):
+                self.run_timers()
+            with profiling.stage('dispatch'):
+                self.dispatch()
+            if self.finished():
+                break
+            if not self.processes:
+                self.log.info('All threads died, exit.')
+                break
+            with profiling.stage('wait'):
+                results = self.wait()
+            now = time.time()
+            for task, status, details in results:
+                self.in_flight -= 1
+                self.tasks.pop(details.get('task'), None)
+                if task == 'GET_PAGE':
+                    self.flow.update(details, now, self.at_limit)
+                with profiling.stage('result'):
+                    self.process_result(task, status, details)
+        self.shutdown()
+
+    def shutdown(self):
+        self.log.debug('Stopping all threads and exitting')
+        self.settings.flush_cookies(force=True)
+        self.settings.close_files()
+        for p in self.processes:
+            self.task_queue.put(('STOP', {}))
+        for p in self.processes:
+            p.join()
+
+    def record_plan(self, id, found):
+        # samples of held blocks decide if the rest of block is crawled (planner.Plan)
+        if self.settings.plan:
+            self.settings.ids.extend(self.settings.plan.record(id, found))
+
+    def save_description(self, id, details):
+        settings = self.settings
+        spooled = details.get('description_file')
+        if settings.descr_store:
+            if spooled:
+                # one description at a time in memory, store needs whole text for chunks
+                with open(spooled, encoding='utf8') as f:
+                    settings.descr_store.put(id, f.read())
+                os.remove(spooled)
+            else:
+                settings.descr_store.put(id, details['description'])
+            return
+        if not os.path.exists(settings.descr_folder):
+            os.mkdir(settings.descr_folder)
+        path = settings.descr_folder + '/%03i/' % (id // 100000)
+        if not os.path.exists(path):
+            os.mkdir(path)
+        filename = path + ('%08i' % id)
+        if spooled:
+            # spool is inside descr folder, so it is rename without reading
+            os.replace(spooled, filename)
+        else:
+            handle_description_file = open(filename, 'w', encoding='utf8')
+            handle_description_file.write(details['description'])
+            handle_description_file.close()
+
+    def process_result(self, task, status, details):
+        settings = self.settings
+        ids_status = self.ids_status
+        log = self.log
+        if task == 'COOKIE':
+            if status == 'OK':
+                log.debug('processing loop. cookie - ok')
+                settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
+                settings.set_cookie(details['username'], details['cookie'])
+            elif status == 'ERROR':
+                log.error('processing loop. cookie - error: %s' % details['text'])
+                settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
+                settings.set_cookie_refresh_error(details['username'])
+            else:
+                log.warning('processing loop. cookie - unknown status:' + status)
+        elif task == 'GET_PAGE':
+            if status == 'OK':
+                ids_status['finished_last'] += 1
+                log.debug('processing loop. get page - OK, id: %s' % str(details['id']))
+                settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
+                settings.set_free_cookie(details['cookie'])
+                id, record = details['id'], details['record']
+                self.save_description(id, details)
+                settings.handle_table_file.write(record.pack())
+                if settings.catalog:
+                    settings.catalog.add_record(record)
+                settings.handle_finished_file.write(str(id) + '\n')
+                self.record_plan(id, True)
+            elif status == 'NO_HASH':
+                ids_status['nohash_last'] += 1
+                log.debug('processing loop. get page - NO HASH, id: %s' % str(details['id']))
+                settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
+                settings.set_free_cookie(details['cookie'])
+                id = details['id']
+                settings.handle_finished_file.write(str(id) + '\n')
+                self.record_plan(id, False)
+            elif status == 'PARSE_ERROR':
+                ids_status['error_last'] += 1
+                log.warning('processing loop. get page - parse error: %s' % details['text'])
+                settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
+                settings.set_free_cookie(details['cookie'])
+                # the same page would fail again, id is not queued again
+                settings.handle_finished_file.write(str(details['id']) + '\n')
+                self.record_plan(details['id'], True)  # page has magnet link
+            elif status == 'ERROR':
+                ids_status['error_last'] += 1
+                log.error('processing loop. get page - error: %s' % details['text'])
+                if details['text'] == 'not logined':
+                    settings.set_error_cookie(details['cookie'])
+                settings.set_free_cookie(details['cookie'])
+                if ('request exception' in details['text']) or ('request timeout exception' in details['text']):
+                    settings.set_error_proxy(details['proxy_ip'], details['proxy_port'])
+                settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
+                settings.ids.append(int(details['id']))
+            else:
+                log.warning('processing loop. get page - unknown status: %s, id: %s' % (status, details['id']))
+        else:
+            log.warning('processing loop. unknown task:' + task)
+
 
 if __name__ == '__main__':
     freeze_support()
@@ -48,169 +470,41 @@ if __name__ == '__main__':
 
     log.info("\n\n\n========== Program started ==========")
 
+    settings = None
+    processes = list()
     try:
         settings = Settings()
+        if settings.profile_folder:
+            # thread workers are profiled together with coordinator
+            profiling.prepare(settings.profile_folder)
+            profiling.start(settings.profile_folder, 'coordinator')
 
-        task_queue = Queue()
-        done_queue = Queue()
-
-        processes = list()
-        log.info("numbers of threads: %i" % settings.threads_num)
-        for i in range(settings.threads_num):
-            p = Process(target=worker, args=(task_queue, done_queue))
-            p.start()
-            processes.append(p)
+        log.info("numbers of threads: %i (%s)" % (settings.threads_num, settings.workers_mode))
+        task_queue, done_queue, processes = start_workers(settings)
 
         settings.prepare_lists()
         settings.open_files()
+        settings.load_cookies()
 
-        def stop_threads_and_exit():
-            log.debug('Stopping all threads and exitting')
-            for i in range(settings.threads_num):
-                task_queue.put(('STOP', {}))
-            exit()
-
+        coordinator = Coordinator(settings, task_queue, done_queue, processes)
         if settings.print:
-            stop_threads_and_exit()
-
-        if len(settings.ids) == 0:
+            coordinator.shutdown()
+        elif len(settings.ids) == 0:
             log.info('Empty input/left list. Terminated')
-            stop_threads_and_exit()
-
-        settings.load_cookies()
-        for i in range(len(settings.login_list)):
-            if ('cookie' not in settings.login_list[i].keys()) or (settings.login_list[i]['cookie'] == ''):
-                proxy = settings.get_free_proxy()
-                work = ('COOKIE', {'username': settings.login_list[i]['username'], 'password': settings.login_list[i]['password'],
-                                   'proxy_ip': proxy['ip'], 'proxy_port': int(proxy['port'])})
-                task_queue.put(work)
-
-        ids_pointer = 0
-        # bulk = 30
-
-        nexttime = time.time()
-        exit_counter = 0
-        status_nexttime = time.time()
-        ids_status = {'finished_all':0, 'error_all':0, 'nohash_all':0,'finished_last':0, 'error_last':0, 'nohash_last':0}
-        while True:
-            if time.time() > status_nexttime:
-                status_nexttime = time.time() + 10
-                speed = (ids_status['finished_last'] + ids_status['nohash_last']) / 10.0
-                if speed != 0:
-                    time_remaining = (len(settings.ids) - ids_pointer) / speed
-                else:
-                    time_remaining = 0
-                m, s = divmod(time_remaining, 60)
-                h, m = divmod(m, 60)
-                print('Last 10 sec: %3d - OK, %3d - NOHASH, %2d - ERROR, Remaining: %ik, %d:%02d"' % (ids_status['finished_last'], ids_status['nohash_last'],
-                                                                                                ids_status['error_last'], (len(settings.ids) - ids_pointer)//1000,h,m))
-                ids_status['finished_all'] += ids_status['finished_last']
-                ids_status['error_all'] += ids_status['error_last']
-                ids_status['nohash_all'] += ids_status['nohash_last']
-                ids_status['finished_last'] = 0
-                ids_status['error_last'] = 0
-                ids_status['nohash_last'] = 0
-            # adding new tasks
-            if (task_queue.qsize() < settings.qsize) and (ids_pointer < len(settings.ids)):
-                exit_counter = 0
-                id_max = min(ids_pointer + settings.qsize, len(settings.ids))
-                for i in range(ids_pointer, id_max):
-                    proxy = settings.get_free_proxy()
-                    if not proxy:
-                        if time.time() > nexttime:
-                            log.info('free proxy not available')
-                            log.debug('proxies: %s' % str(settings.proxy_list))
-                            nexttime = time.time() + 60
-                        break
-                    cookie = settings.get_free_cookie()
-                    if not cookie:
-                        if time.time() > nexttime:
-                            log.info('free cookie not available')
-                            log.debug('cookies: %s' % str(settings.login_list))
-                            nexttime = time.time() + 60
-                        break
-                    work = ('GET_PAGE', {'id': int(settings.ids[i]), 'cookie': cookie, 'headers': settings.headers, 'proxy_ip': proxy['ip'], 'proxy_port': int(proxy['port'])})
-                    task_queue.put(work)
-                    ids_pointer += 1
-
-            if task_queue.empty() and done_queue.empty():
-                # common part
-                if exit_counter > 1:
-                    log.info('Queues are empty.')
-                time.sleep(1)
-                exit_counter += 1
-                if exit_counter > 5:
-                    stop_threads_and_exit()
-            else:
-                exit_counter = 0
-
-            try:
-                task, status, details = done_queue.get(timeout=1)
-            except queue.Empty:
-                anybody_alive = False
-                for j in range(len(processes)):
-                    if processes[j].is_alive():
-                        anybody_alive = True
-                        break
-                if anybody_alive:
-                    continue
-                else:
-                    log.info('All threads died, exit.')
-                    exit()
-
-            s = signal.signal(signal.SIGINT, signal.SIG_IGN)
-            if task == 'COOKIE':
-                if status == 'OK':
-                    log.debug('processing loop. cookie - ok')
-                    settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
-                    settings.set_cookie(details['username'], details['cookie'])
-                elif status == 'ERROR':
-                    log.error('processing loop. cookie - error: %s' % details['text'])
-                    settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
-                    # settings.set_cookie_error(details['username'])
-                else:
-                    log.warning('processing loop. cookie - unknown status:' + status)
-            elif task == 'GET_PAGE':
-                if status == 'OK':
-                    ids_status['finished_last'] += 1
-                    log.debug('processing loop. get page - OK, id: %s' % str(details['id']))
-                    settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
-                    settings.set_free_cookie(details['cookie'])
-                    id, line, description = details['id'], details['line'], details['description']
-                    if not os.path.exists(settings.descr_folder):
-                        os.mkdir(settings.descr_folder)
-                    path = settings.descr_folder + '/%03i/' % (id // 100000)
-                    if not os.path.exists(path):
-                        os.mkdir(path)
-                    filename = path + ('%08i' % id)
-                    handle_description_file = open(filename, 'w', encoding='utf8')
-                    handle_description_file.write(description)
-                    handle_description_file.close()
-                    settings.handle_table_file.write(line + '\n')
-                    settings.handle_finished_file.write(str(id) + '\n')
-                elif status == 'NO_HASH':
-                    ids_status['nohash_last'] += 1
-                    log.debug('processing loop. get page - NO HASH, id: %s' % str(details['id']))
-                    settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
-                    settings.set_free_cookie(details['cookie'])
-                    id = details['id']
-                    settings.handle_finished_file.write(str(id) + '\n')
-                elif status == 'ERROR':
-                    ids_status['error_last'] += 1
-                    log.error('processing loop. get page - error: %s' % details['text'])
-                    if details['text'] == 'not logined':
-                        settings.set_error_cookie(details['cookie'])
-                    settings.set_free_cookie(details['cookie'])
-                    if ('request exception' in details['text']) or ('request timeout exception' in details['text']):
-                        settings.set_error_proxy(details['proxy_ip'], details['proxy_port'])
-                    settings.set_free_proxy(details['proxy_ip'], details['proxy_port'])
-                    settings.ids.append(int(details['id']))
-                else:
-                    log.warning('processing loop. get page - unknown status: %s, id: %s' % (status, details['id']))
-            else:
-                log.warning('processing loop. unknown task:' + task)
-            signal.signal(signal.SIGINT, s)
+            coordinator.shutdown()
+        else:
+            coordinator.run()
+        if settings.profile_folder:
+            profiling.stop()
+            log.info('profile: %s, %s' % (profiling.merge(settings.profile_folder),
+                                          os.path.join(settings.profile_folder, 'merged.folded')))
 
     except KeyboardInterrupt:
         log.info('Ctrl+^C, exitting...')
+        if settings:
+            settings.flush_cookies(force=True)
+            settings.flush_files()
+        for p in processes:
+            if isinstance(p, Process):
+                p.terminate()
         exit()
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 
-from html.parser import unescape
+from html import unescape
+import logging
 import socks
 import requests
 import socket
+import profiling
+from record import Record, parse_date, hash_bytes
+
+
+page_url = 'https://rutracker.org/forum/viewtopic.php?t=%i'
 
 
 def get_cookie(params):
@@ -13,8 +19,11 @@ def get_cookie(params):
         if key != 'logger': # not serializable object
             res[key] = params[key]
     if params['proxy_port'] != -1:
-        socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, params['proxy_ip'], params['proxy_port'])
+        # proxy only for calling thread, workers can be threads of one process
+        socks.setthreadproxy(socks.PROXY_TYPE_SOCKS5, params['proxy_ip'], params['proxy_port'])
         socket.socket = socks.socksocket
+    else:
+        socks.setthreadproxy()
     try:
         post_params = {
             'login_username': params['username'].encode('cp1251'),
@@ -47,26 +56,29 @@ def get_cookie(params):
         return 'ERROR', res
 
 
-def get_page(params):
-    log = params['logger']
-    res = {}
-    for key in params:
-        if key != 'logger': # not serializable object
-            res[key] = params[key]
-    # log.debug('get_page start')
-    if params['proxy_port'] != -1:
-        socks.setdefaultproxy(socks.PROXY_TYPE_SOCKS5, params['proxy_ip'], params['proxy_port'])
-        socket.socket = socks.socksocket
+def between(text, p_from, p_to):
+    return text.split(p_from)[1].split(p_to)[0]
+
+
+def to_count(text, name, id, log):
+    # odd counter isn't worth a lost record, it is stored as 0
+    try:
+        return int(text.replace(',', '').strip())
+    except ValueError:
+        log.warning('parser, %s, not a number: %r, id: %i' % (name, text, id))
+        return 0
+
 
-    def between(text, p_from, p_to):
-        return text.split(p_from)[1].split(p_to)[0]
+def parse_page(html, id, log=None):
+    """Parse html of topic, return (status, result) like get_page without fetching.
 
+    status - 'OK' (result has 'record' - record.Record and 'description'),
+    'NO_HASH', 'ERROR' or 'PARSE_ERROR' (result has 'text'). PARSE_ERROR -
+    page is loaded but can't be a record, loading it again won't help.
+    """
+    log = log or logging.getLogger(__name__)
+    res = {}
     try:
-        path = '/forum/viewtopic.php?t=%(id)i' % {'id': params['id']}
-        url = 'https://rutracker.org%(path)s' % {'path': path}
-        params['headers']['Cookie'] = params['cookie']
-        req = requests.get(url, headers=params['headers'], timeout=20)
-        html = req.text
         if not (('<html' in html) or ('HTML' in html)):
             res['text'] = 'not html in response'
             return 'ERROR', res
@@ -82,13 +94,13 @@ def get_page(params):
             return 'NO_HASH', res
         else:
             line = list()
-            line.append(str(params['id']))
+            line.append(id)
             title = between(html, '<title>', ' :: RuTracker.org')
             title = unescape(title)
             line.append(title)
             size = between(html, '<span id="tor-size-humn" title="', '">') #  '<span id="tor-size-humn"', '</span>')
             if not size.isdigit():
-                error_text = 'parser, size, not only numbers, id: %i' % params['id']
+                error_text = 'parser, size, not only numbers, id: %i' % id
                 log.warning(error_text)
                 res['text'] = error_text
                 return 'ERROR', res
@@ -98,7 +110,7 @@ def get_page(params):
                 seeds = between(html, 'seed">Сиды:&nbsp; <b>', '</b>')
             else:
                 seeds = '0'
-                # error_text = 'parser, seeds, template not found, id: %i' % params['id']
+                # error_text = 'parser, seeds, template not found, id: %i' % id
                 # log.debug(error_text)
                 # res['text'] = error_text
                 # return 'ERROR', res
@@ -108,7 +120,7 @@ def get_page(params):
                 peers = between(html, 'leech">Личи:&nbsp; <b>', '</b>')
             else:
                 peers = '0'
-                # error_text = 'parser, peers, template not found, id: %i' % params['id']
+                # error_text = 'parser, peers, template not found, id: %i' % id
                 # log.debug(error_text)
                 # res['text'] = error_text
                 # return 'ERROR', res
@@ -124,13 +136,13 @@ def get_page(params):
             elif ('Скачан: ' in html) and ('раз\t\t</td>' in html):
                 downloads = between(html, 'Скачан: ', 'раз\t\t</td>').strip()
             else:
-                error_text = 'parser, downloads, template not found, id: %i' % params['id']
+                error_text = 'parser, downloads, template not found, id: %i' % id
                 log.warning(error_text)
                 res['text'] = error_text
                 return 'ERROR', res
             downloads = downloads.replace(',', '')
             if not downloads.isdigit():
-                error_text = 'parser, downloads, bad template, id: %i' % params['id']
+                error_text = 'parser, downloads, bad template, id: %i' % id
                 log.warning(error_text)
                 res['text'] = error_text
                 return 'ERROR', res
@@ -140,7 +152,7 @@ def get_page(params):
                 date = between(html, '>Зарегистрирован:</td>', '</td>')
                 date = between(date, '<li>', '</li>')
             else:
-                error_text = 'parser, date, template not found, id: %i' % params['id']
+                error_text = 'parser, date, template not found, id: %i' % id
                 log.warning(error_text)
                 res['text'] = error_text
                 return 'ERROR', res
@@ -161,7 +173,16 @@ def get_page(params):
             category_string = category_string[:-3]
             line.append(category_string)
 
-            line = '\t'.join(line)
+            id, title, size, seeds, peers, hash, downloads, date, category = line
+            hash = hash_bytes(hash)
+            if hash is None:
+                error_text = 'parser, hash, not a btih, id: %i' % id
+                log.warning(error_text)
+                res['text'] = error_text
+                return 'PARSE_ERROR', res
+            record = Record(id, title, to_count(size, 'size', id, log), to_count(seeds, 'seeds', id, log),
+                            to_count(peers, 'peers', id, log), hash, to_count(downloads, 'downloads', id, log),
+                            parse_date(date), category)
             descr = between(html, '<div class="post_body" id="', '<div class="clear"')
             descr = descr.split('>', 1)[1]
             descr = descr.strip()
@@ -170,9 +191,77 @@ def get_page(params):
             elif descr.endswith('</div>'):
                 descr = descr[:-6].strip()
             descr = unescape(descr)
-            res['line'] = line
+            res['record'] = record
             res['description'] = descr
             return 'OK', res
+    except Exception:
+        error_text = 'unknown error, id: %i' % id
+        log.exception(error_text)
+        res['text'] = error_text
+        return 'ERROR', res
+
+
+def open_connection(session, url, timeout=20):
+    """Open keep-alive connection of session to host of url (proxy and TLS handshake) unless one is idle.
+
+    So the handshake is timed apart from the request. Failure is left to
+    the request, it reports it as usual.
+    """
+    adapter = session.get_adapter(url)
+    try:
+        # the same pool as session.get will take (key includes ca bundle of environment)
+        request = session.prepare_request(requests.Request('GET', url))
+        settings = session.merge_environment_settings(request.url, {}, None, None, None)
+        if hasattr(adapter, 'get_connection_with_tls_context'):
+            pool = adapter.get_connection_with_tls_context(request, settings['verify'], settings['proxies'],
+                                                           settings['cert'])
+        else:
+            pool = adapter.get_connection(url, settings['proxies'])
+        # urllib3 has no public call to connect without sending a request
+        connection = pool._get_conn(timeout=timeout)
+    except Exception:
+        return
+    try:
+        if connection.sock is None:
+            connection.timeout = timeout
+            connection.connect()
+    except Exception:
+        connection.close()
+    pool._put_conn(connection)
+
+
+def get_page(params):
+    log = params['logger']
+    res = {}
+    for key in params:
+        if key not in ('logger', 'session', 'headers'): # not serializable objects, headers aren't needed in result
+            res[key] = params[key]
+    # log.debug('get_page start')
+    if params['proxy_port'] != -1:
+        # proxy only for calling thread, workers can be threads of one process
+        socks.setthreadproxy(socks.PROXY_TYPE_SOCKS5, params['proxy_ip'], params['proxy_port'])
+        socket.socket = socks.socksocket
+    else:
+        socks.setthreadproxy()
+
+    # session - warm connection through the same proxy (see connpool.py)
+    session = params.get('session')
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+    try:
+        url = page_url % params['id']
+        # own copy: thread workers share headers of the task, Cookie of another thread would be sent
+        headers = dict(params['headers'], Cookie=params['cookie'])
+        with profiling.stage('connect'):
+            open_connection(session, url)
+        with profiling.stage('fetch'):
+            req = session.get(url, headers=headers, timeout=20)
+            html = req.text
+        with profiling.stage('parse'):
+            status, result = parse_page(html, params['id'], log)
+        res.update(result)
+        return status, res
     except requests.exceptions.RequestException as e:
         error_text = 'request exception, id: %i' % params['id']
         log.debug(error_text, exc_info=True)
@@ -193,3 +282,6 @@ def get_page(params):
         log.exception(error_text)
         res['text'] = error_text
         return 'ERROR', res
+    finally:
+        if own_session:
+            session.close()
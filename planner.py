@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""Orders ids for crawling by results of previous crawls.
+
+Ids are grouped into blocks of block_size. Density of a block is the part
+of its ids which had a torrent (row in table.bin) among ids tried before
+(finished.txt). Blocks without history and sparse blocks are sampled
+first, then dense blocks are crawled. The rest of a sampled block is
+crawled only when its samples are answered and found a torrent; a block
+whose min_samples or more samples found nothing is skipped (its ids are
+kept in Plan.skipped).
+"""
+
+import logging
+import os
+import random
+from collections import defaultdict
+
+import record
+
+log = logging.getLogger(__name__)
+
+
+def read_ids(filename, separator=None):
+    ids = []
+    for line in open(filename, encoding='utf8'):
+        value = line.split(separator, 1)[0].strip() if separator else line.strip()
+        if value.isdigit():
+            ids.append(int(value))
+    return ids
+
+
+def block_stats(folder='.', block_size=1000, finished_file='finished.txt', table_files=('table.bin', 'table.txt')):
+    """Return {block: [tried, found]} from finished.txt and table.bin (table.txt of older crawls) in folder"""
+    stats = defaultdict(lambda: [0, 0])
+    finished_path = os.path.join(folder, finished_file)
+    if os.path.isfile(finished_path):
+        for id in set(read_ids(finished_path)):
+            stats[id // block_size][0] += 1
+    found = set()
+    for table_file in table_files:
+        table_path = os.path.join(folder, table_file)
+        if table_file.endswith('.txt') and os.path.isfile(table_path):
+            found.update(read_ids(table_path, '\t'))
+        elif os.path.isfile(table_path):
+            found.update(row.id for row in record.read_table(table_path))
+    for id in found:
+        stats[id // block_size][1] += 1
+    for block in stats:
+        # table can have ids missing in finished.txt (e.g. lost on crash)
+        stats[block][0] = max(stats[block][0], stats[block][1])
+    return dict(stats)
+
+
+def in_shard(id, shard, block_size=1000):
+    """shard - (index, count), whole blocks go to the same shard"""
+    index, count = shard
+    return (id // block_size) % count == index
+
+
+class Plan:
+    """Crawl order of ids, grows as samples of held blocks are answered (see record)"""
+
+    def __init__(self, ids, stats, block_size=1000, sample_rate=0.05, min_density=0.05, min_samples=20):
+        self.block_size = block_size
+        self.min_samples = min_samples
+        self.held = {}  # block -> rest of its ids and counts of samples, see record
+        self.skipped = []
+        blocks = defaultdict(list)
+        for id in ids:
+            blocks[id // block_size].append(id)
+
+        samples = []
+        dense = []
+        unknown = 0
+        sparse = 0
+        for block, block_ids in blocks.items():
+            block_ids.sort(reverse=True)
+            tried, found = stats.get(block, (0, 0))
+            density = found / tried if tried else None
+            if density is not None and density >= min_density:
+                dense.append((density, block, block_ids))
+                continue
+            # unknown and sparse blocks: some random ids first to see if they are worth crawling
+            random.shuffle(block_ids)
+            count = max(1, int(len(block_ids) * sample_rate))
+            samples.extend(block_ids[:count])
+            rest = sorted(block_ids[count:], reverse=True)
+            if rest:
+                self.held[block] = [rest, count, count, 0]  # rest, samples not answered, samples, with torrent
+            if density is None:
+                unknown += 1
+            else:
+                sparse += 1
+
+        # new topics are at the end of range - higher blocks first when equal
+        dense.sort(reverse=True)
+        log.info('plan: %i dense blocks, %i unknown, %i sparse, %i sample ids' % (len(dense), unknown, sparse, len(samples)))
+
+        samples.sort(reverse=True)
+        self.ids = samples
+        for density, block, block_ids in dense:
+            self.ids.extend(block_ids)
+
+    def record(self, id, found):
+        """Answer for id (found - it has a torrent), return ids to crawl now (rest of its block if decided)"""
+        block = id // self.block_size
+        if block not in self.held:
+            # dense block or rest of decided one - nothing to decide
+            return []
+        # ids of held block are not given out, so answered id is a sample
+        held = self.held[block]
+        held[1] -= 1
+        held[3] += 1 if found else 0
+        if held[1] > 0:
+            return []
+        rest, left, count, hits = self.held.pop(block)
+        if not hits and count >= self.min_samples:
+            log.info('plan: no torrents in %i samples of block %i, %i ids skipped' % (count, block, len(rest)))
+            self.skipped.extend(rest)
+            return []
+        return rest
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+"""Opt-in profiling of crawl runs (loader.py --profile).
+
+Two things are collected in every process:
+* stage timers - count and wall time of named stages (sleep, fetch, write...),
+  wrapped by `with profiling.stage('name'):`, free when profiling is off;
+* stack samples - a thread takes stacks of all threads every `interval`
+  seconds and counts them in collapsed form ('frame;frame;frame count').
+
+At exit every process writes <role>-<pid>.folded and <role>-<pid>.json into
+the profile folder, merge() sums them into merged.folded (input for
+flamegraph.pl or speedscope) and stages.txt.
+
+Usage (standalone):
+    python3 ./profiling.py profile      # merge files of a finished run again
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+interval = 0.005
+
+enabled = False
+_folder = None
+_role = None
+_sampler = None
+_stages = []  # stage dicts of all threads: name -> [count, seconds]
+_stages_lock = threading.Lock()
+_local = threading.local()
+_null = contextlib.nullcontext()
+
+
+def _thread_stages():
+    stages = getattr(_local, 'stages', None)
+    if stages is None:
+        stages = _local.stages = {}
+        with _stages_lock:
+            _stages.append(stages)
+    return stages
+
+
+@contextlib.contextmanager
+def _timed(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry = _thread_stages().setdefault(name, [0, 0.0])
+        entry[0] += 1
+        entry[1] += time.perf_counter() - start
+
+
+def stage(name):
+    """Context manager timing stage 'name' (does nothing when profiling is off)"""
+    if not enabled:
+        return _null
+    return _timed(name)
+
+
+class Sampler(threading.Thread):
+    def __init__(self):
+        super(Sampler, self).__init__(name='profile-sampler', daemon=True)
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(interval):
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('%s (%s)' % (code.co_name, os.path.basename(code.co_filename)))
+                    frame = frame.f_back
+                frames.append(names.get(ident, 'thread-%i' % ident))
+                self.stacks[';'.join(reversed(frames))] += 1
+
+
+def prepare(folder):
+    """Remove files of previous run (call before workers are started)"""
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    for name in os.listdir(folder):
+        if name.endswith('.folded') or name.endswith('.json') or name == 'stages.txt':
+            os.remove(os.path.join(folder, name))
+
+
+def start(folder, role):
+    global enabled, _folder, _role, _sampler, _stages, _local
+    # forked worker starts with copy of coordinator's state
+    _stages = []
+    _local = threading.local()
+    enabled = True
+    _folder = folder
+    _role = role
+    _sampler = Sampler()
+    _sampler.start()
+
+
+def stop():
+    """Stop sampling and write files of this process"""
+    global enabled, _sampler
+    if not enabled:
+        return
+    enabled = False
+    _sampler.stopped.set()
+    _sampler.join()
+    name = os.path.join(_folder, '%s-%i' % (_role, os.getpid()))
+    with open(name + '.folded', 'w', encoding='utf8') as f:
+        for stack, count in _sampler.stacks.most_common():
+            f.write('%s %i\n' % (stack, count))
+    totals = {}
+    with _stages_lock:
+        for stages in _stages:
+            for stage_name, (count, seconds) in stages.items():
+                total = totals.setdefault(stage_name, [0, 0.0])
+                total[0] += count
+                total[1] += seconds
+    with open(name + '.json', 'w') as f:
+        json.dump({'role': _role, 'pid': os.getpid(), 'interval': interval, 'stages': totals}, f)
+    _sampler = None
+
+
+def merge(folder):
+    """Sum files of all processes into merged.folded and stages.txt"""
+    stacks = Counter()
+    stages = {}  # role -> stage -> [count, seconds]
+    processes = Counter()
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if name.endswith('.json'):
+            data = json.load(open(path))
+            processes[data['role']] += 1
+            for stage_name, (count, seconds) in data['stages'].items():
+                total = stages.setdefault(data['role'], {}).setdefault(stage_name, [0, 0.0])
+                total[0] += count
+                total[1] += seconds
+        elif name.endswith('.folded') and name != 'merged.folded':
+            role = name.rsplit('-', 1)[0]
+            for line in open(path, encoding='utf8'):
+                stack, count = line.rstrip('\n').rsplit(' ', 1)
+                stacks[role + ';' + stack] += int(count)
+    with open(os.path.join(folder, 'merged.folded'), 'w', encoding='utf8') as f:
+        for stack, count in stacks.most_common():
+            f.write('%s %i\n' % (stack, count))
+    with open(os.path.join(folder, 'stages.txt'), 'w', encoding='utf8') as f:
+        for role in sorted(stages):
+            f.write('%s (%i processes)\n' % (role, processes[role]))
+            # stages can be nested (fetch is inside page), times are not summed
+            for stage_name, (count, seconds) in sorted(stages[role].items(), key=lambda item: -item[1][1]):
+                f.write('  %-16s %9i calls %10.2f s %9.2f ms/call\n' % (
+                    stage_name, count, seconds, seconds * 1000 / max(count, 1)))
+    return os.path.join(folder, 'stages.txt')
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='merge profiles of processes of a crawl run')
+    ap.add_argument('folder', nargs='?', default='profile')
+    options = ap.parse_args()
+    print(open(merge(options.folder), encoding='utf8').read())
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+"""Checks proxies from proxy list: handshake latency and throughput.
+
+Usage (standalone):
+    python3 ./proxycheck.py --proxy_file proxy.txt --target https://rutracker.org/forum/index.php
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+import urllib.parse
+
+import socks
+
+default_target = 'https://rutracker.org/forum/index.php'
+
+
+class ProxyProber:
+    """Probes all proxies concurrently on one event loop.
+
+    Results are cached in cache_file for ttl seconds, so restarts don't
+    probe again. Result for each proxy is a dict with 'alive', 'latency'
+    (seconds to connect and negotiate through proxy, with TLS for https
+    target), 'throughput' (bytes per second of the target's response) and
+    'checked' (time of probe).
+    """
+
+    def __init__(self, target=default_target, timeout=10, ttl=3600, cache_file='proxy_probe.json', concurrency=200,
+                 max_bytes=65536):
+        self.log = logging.getLogger(__name__)
+        url = urllib.parse.urlsplit(target)
+        self.tls = url.scheme == 'https'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.tls else 80)
+        self.path = (url.path or '/') + ('?' + url.query if url.query else '')
+        self.timeout = timeout
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.concurrency = concurrency
+        self.max_bytes = max_bytes
+        self.cache = self.load_cache()
+        self.thread = None
+        self.pending_results = None
+
+    @staticmethod
+    def key(ip, port):
+        return '%s:%i' % (ip, port)
+
+    def load_cache(self):
+        if self.cache_file and os.path.isfile(self.cache_file):
+            try:
+                cache = json.load(open(self.cache_file))
+                if cache.get('target') == self.target_name():
+                    return cache['results']
+            except (ValueError, KeyError):
+                self.log.warning('broken proxy probe cache, ignored')
+        return {}
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        temp_filename = self.cache_file + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump({'target': self.target_name(), 'results': self.cache}, f)
+        os.replace(temp_filename, self.cache_file)
+
+    def target_name(self):
+        return '%s://%s:%i%s' % ('https' if self.tls else 'http', self.host, self.port, self.path)
+
+    async def probe_one(self, ip, port, semaphore):
+        result = {'alive': False, 'latency': None, 'throughput': None, 'checked': time.time()}
+        async with semaphore:
+            start = time.perf_counter()
+            writer = None
+            try:
+                context = ssl.create_default_context() if self.tls else None
+                reader, writer = await socks.open_connection(
+                    self.host, self.port, proxy=(socks.PROXY_TYPE_SOCKS5, ip, port), connect_timeout=self.timeout,
+                    handshake_timeout=self.timeout, ssl=context)
+                result['latency'] = time.perf_counter() - start
+                request_time = time.perf_counter()
+                writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' % (self.path, self.host)).encode())
+                received = 0
+                while received < self.max_bytes:
+                    data = await asyncio.wait_for(reader.read(self.max_bytes - received), self.timeout)
+                    if not data:
+                        break
+                    received += len(data)
+                if received:
+                    result['alive'] = True
+                    result['throughput'] = received / max(time.perf_counter() - request_time, 1e-6)
+            except (OSError, asyncio.TimeoutError, socks.ProxyError, ssl.SSLError) as e:
+                result['error'] = repr(e)
+            finally:
+                if writer:
+                    writer.close()
+        return self.key(ip, port), result
+
+    async def probe_all(self, proxies):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        return dict(await asyncio.gather(*[self.probe_one(ip, port, semaphore) for ip, port in proxies]))
+
+    def probe(self, proxies, force=False):
+        """probe([(ip, port), ...]) -> {'ip:port': result}, fresh cached results are reused"""
+        now = time.time()
+        proxies = list(proxies)
+        stale = [(ip, port) for ip, port in proxies if force or self.key(ip, port) not in self.cache or
+                 now - self.cache[self.key(ip, port)]['checked'] > self.ttl]
+        if stale:
+            self.log.info('probing %i proxies (%i cached)' % (len(stale), len(proxies) - len(stale)))
+            self.cache.update(asyncio.run(self.probe_all(stale)))
+            self.save_cache()
+        return {self.key(ip, port): self.cache[self.key(ip, port)] for ip, port in proxies}
+
+    def start(self, proxies):
+        """Probe in background thread (forced), take results by results()"""
+        if self.thread and self.thread.is_alive():
+            return
+
+        def run():
+            self.pending_results = self.probe(proxies, force=True)
+
+        self.pending_results = None
+        self.thread = threading.Thread(target=run, name='proxy-probe', daemon=True)
+        self.thread.start()
+
+    def results(self):
+        """Results of background probe once it finished, else None"""
+        if self.thread and not self.thread.is_alive() and self.pending_results is not None:
+            results, self.pending_results = self.pending_results, None
+            return results
+        return None
+
+
+def rank(results):
+    """Keys of alive proxies, fastest first"""
+    alive = [(key, result) for key, result in results.items() if result['alive']]
+    alive.sort(key=lambda item: (item[1]['latency'], -item[1]['throughput']))
+    return [key for key, result in alive]
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--proxy_file', '-pf', default='proxy.txt')
+    ap.add_argument('--target', default=default_target)
+    ap.add_argument('--timeout', type=float, default=10)
+    ap.add_argument('--force', action="store_true", help="don't use cached results")
+    options = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    proxies = []
+    for line in open(options.proxy_file):
+        if line.strip():
+            ip, port = line.split()
+            proxies.append((ip, int(port)))
+    results = ProxyProber(options.target, options.timeout).probe(proxies, options.force)
+    for key in rank(results):
+        print('%-22s  %6.0f ms  %8.1f KB/s' % (key, results[key]['latency'] * 1000, results[key]['throughput'] / 1024))
+    print('alive: %i of %i' % (len(rank(results)), len(results)))
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""Row of the table as typed record with compact binary form.
+
+Binary form (used between processes and in table.bin) is a fixed part
+'<IqIIIq20sHH' (id, size, seeds, peers, downloads, date, hash, lengths of
+name and category) followed by utf8 name and category. TSV (table.txt
+columns) is only an export format.
+
+Usage (standalone):
+    python3 ./record.py export table.bin table.txt
+    python3 ./record.py import table.txt table.bin
+"""
+
+import argparse
+import base64
+import calendar
+import logging
+import os
+import re
+import struct
+from datetime import datetime, timezone
+
+columns = ('id', 'name', 'size', 'seeds', 'peers', 'hash', 'downloads', 'date', 'category')
+
+header = struct.Struct('<IqIIIq20sHH')
+
+log = logging.getLogger(__name__)
+
+
+def parse_date(text):
+    # dates are stored as naive 'dd-mm-yy HH:MM' (older rows keep english month names)
+    for date_format in ('%d-%m-%y %H:%M', '%d-%b-%y %H:%M'):
+        try:
+            return calendar.timegm(datetime.strptime(text, date_format).timetuple())
+        except ValueError:
+            pass
+    if text:
+        # kept as 0 (no date), warning shows the format to add here
+        log.warning('unknown date format: %r' % text)
+    return 0
+
+
+def format_date(timestamp):
+    if not timestamp:
+        return ''
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%d-%m-%y %H:%M')
+
+
+def hash_bytes(text):
+    """20 bytes from hex or base32 btih of magnet link, None if it is neither"""
+    if re.fullmatch('[0-9a-fA-F]{40}', text):
+        return bytes.fromhex(text)
+    if re.fullmatch('[A-Za-z2-7]{32}', text):
+        return base64.b32decode(text.upper())
+    return None
+
+
+def tsv_text(text):
+    # tab or newline in title would break the row
+    return text.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+
+class Record:
+    __slots__ = columns
+
+    def __init__(self, id, name, size, seeds, peers, hash, downloads, date, category):
+        self.id = id
+        self.name = name
+        self.size = size
+        self.seeds = seeds
+        self.peers = peers
+        self.hash = hash  # 20 bytes
+        self.downloads = downloads
+        self.date = date  # seconds since epoch
+        self.category = category
+
+    @classmethod
+    def from_item(cls, item):
+        """From list of column strings (table.txt row)"""
+        item = list(item) + [''] * (len(columns) - len(item))
+        return cls(int(item[0]), item[1], int(item[2]), int(item[3]), int(item[4]), bytes.fromhex(item[5]),
+                   int(item[6]), parse_date(item[7]), item[8])
+
+    def to_item(self):
+        return [str(self.id), tsv_text(self.name), str(self.size), str(self.seeds), str(self.peers), self.hash_hex(),
+                str(self.downloads), format_date(self.date), tsv_text(self.category)]
+
+    def to_line(self):
+        return '\t'.join(self.to_item())
+
+    def hash_hex(self):
+        return self.hash.hex().upper()
+
+    def pack(self):
+        name = self.name.encode('utf8')
+        category = self.category.encode('utf8')
+        return header.pack(self.id, self.size, self.seeds, self.peers, self.downloads, self.date, self.hash,
+                           len(name), len(category)) + name + category
+
+    @classmethod
+    def unpack_from(cls, data, offset=0):
+        """(record, offset of next record)"""
+        id, size, seeds, peers, downloads, date, hash, name_length, category_length = header.unpack_from(data, offset)
+        offset += header.size
+        name = bytes(data[offset:offset + name_length]).decode('utf8')
+        offset += name_length
+        category = bytes(data[offset:offset + category_length]).decode('utf8')
+        offset += category_length
+        return cls(id, name, size, seeds, peers, hash, downloads, date, category), offset
+
+    @classmethod
+    def unpack(cls, data):
+        return cls.unpack_from(data)[0]
+
+    def __reduce__(self):
+        # pickled (multiprocessing queues) in binary form
+        return Record.unpack, (self.pack(),)
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and all(getattr(self, name) == getattr(other, name) for name in columns)
+
+    def __repr__(self):
+        return 'Record(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in columns)
+
+
+def iter_records(f, block_size=1 << 20):
+    """Yield (record, file position after it), stop at incomplete record"""
+    data = b''
+    offset = 0
+    position = 0  # of data[0]
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return
+        position += offset
+        data = data[offset:] + block
+        offset = 0
+        while len(data) - offset >= header.size:
+            name_length, category_length = struct.unpack_from('<HH', data, offset + header.size - 4)
+            if len(data) - offset < header.size + name_length + category_length:
+                break
+            record, offset = Record.unpack_from(data, offset)
+            yield record, position + offset
+
+
+def read_records(f):
+    """Yield records from binary file"""
+    for record, position in iter_records(f):
+        yield record
+
+
+def repair(filename):
+    """Cut incomplete record at the end of table.bin (write interrupted by crash), return removed bytes"""
+    if not os.path.isfile(filename):
+        return 0
+    with open(filename, 'r+b') as f:
+        end = 0
+        for record, end in iter_records(f):
+            pass
+        size = f.seek(0, os.SEEK_END)
+        if size != end:
+            f.truncate(end)
+    return size - end
+
+
+def read_table(filename):
+    """Records of table.bin, or of table.txt for tables written before table.bin"""
+    if filename.endswith('.txt'):
+        with open(filename, encoding='utf8') as f:
+            for line in f:
+                item = line.rstrip('\n').split('\t')
+                if item[0].isdigit():
+                    try:
+                        row = Record.from_item(item)
+                    except ValueError:
+                        # row of early parser versions (not a number or hash), not worth a crash of sort.py
+                        continue
+                    yield row
+    else:
+        with open(filename, 'rb') as f:
+            yield from read_records(f)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='convert table between binary and tsv')
+    ap.add_argument('command', choices=('export', 'import'))
+    ap.add_argument('source')
+    ap.add_argument('destination')
+    options = ap.parse_args()
+
+    count = 0
+    if options.command == 'export':
+        with open(options.destination, 'w', encoding='utf8') as f:
+            for record in read_table(options.source):
+                f.write(record.to_line() + '\n')
+                count += 1
+    else:
+        with open(options.destination, 'wb') as f:
+            for record in read_table(options.source):
+                f.write(record.pack())
+                count += 1
+    print('%i records' % count)
@@ -0,0 +1,579 @@
+#!/usr/bin/env python3
+
+"""Search through local copy of rutracker without GUI.
+
+Usage:
+    python3 ./search.py 'word -word limit:5' --category 'word'
+    python3 ./search.py 'word sort:date'      # newest first ('sort:-size' - smallest first, 'sort:relevance')
+    python3 ./search.py --categories
+    python3 ./search.py 'word' --category-id 12   # rows of category 12 and its subcategories (needs catalog)
+    python3 ./search.py 'word' --magnets > links.txt   # magnet links of all results
+    python3 ./search.py --serve 8080
+and then http://127.0.0.1:8080/search?q=word+-word+limit:5&category=word (or &category_id=12)
+or http://127.0.0.1:8080/categories
+or http://127.0.0.1:8080/magnets?q=word (all results, one link per line)
+"""
+
+import argparse
+import bz2
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import threading
+import urllib.parse
+from collections import OrderedDict
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tarfile import TarFile
+
+import catalog
+
+columns = catalog.columns
+
+table_archive = 'table_sorted.tar.bz2'
+# sorted table split into independently compressed parts (see sort.py)
+chunks_folder = 'table_sorted'
+chunk_rows = 20000
+
+name_column = columns.index('name')
+seeds_column = columns.index('seeds')
+category_column = columns.index('category')
+default_limit = 20
+default_order = 'seeds'  # order of sorted table, other orders need top-K over all matches
+
+# trackers for magnet links, one per line in trackers_file replace default ones
+trackers_file = 'trackers.txt'
+default_trackers = ('http://bt.t-ru.org/ann?magnet',
+                    'http://retracker.local/announce')
+trackers = None  # loaded on first magnet link
+
+_executor = None
+_executor_lock = threading.Lock()  # warm_up thread and first search can ask at the same time
+
+
+def get_executor():
+    # one pool for the whole program, starting workers for every search is too slow
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn: fork of a process with Qt and other threads running can deadlock in the child
+            _executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+
+def warm_up():
+    # starts pool processes, so first search doesn't pay for it
+    if chunk_files():
+        executor = get_executor()
+        for future in [executor.submit(os.getpid) for i in range(os.cpu_count() or 1)]:
+            future.result()
+
+
+def chunk_files(folder=chunks_folder):
+    if not os.path.isdir(folder):
+        return []
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder)) if name.endswith('.bz2')]
+
+
+def match_category(category, words_category):
+    category = category.lower()
+    for w in words_category:
+        if w not in category:
+            return False
+    return True
+
+
+def match(item, words_contains, words_not_contains, words_category):
+    # all words must be lowercased already
+    name = item[name_column].lower()
+    for w in words_contains:
+        if w not in name:
+            return False
+    for w in words_not_contains:
+        if w in name:
+            return False
+    if words_category:
+        return match_category(item[category_column] if len(item) > category_column else '', words_category)
+    return True
+
+
+def scan_lines(lines, words_contains, words_not_contains, words_category, limit, cancel=None):
+    # few thousands of categories for millions of rows - each one is checked once
+    category_matches = {}
+    for i, line in enumerate(lines):
+        if cancel is not None and not i & 0xfff and cancel.is_set():
+            return
+        item = line.strip().split(sep='\t')
+        if words_category:
+            category = item[category_column] if len(item) > category_column else ''
+            if category not in category_matches:
+                category_matches[category] = match_category(category, words_category)
+            if not category_matches[category]:
+                continue
+        if match(item, words_contains, words_not_contains, ()):
+            yield item
+            limit -= 1
+            if limit <= 0:
+                break
+
+
+def rank_key(order, words_contains):
+    column, ascending = catalog.split_order(order)
+    if column == 'relevance':
+        return lambda item: catalog.relevance(item[name_column], catalog.to_int(item[seeds_column]), words_contains)
+    index = columns.index(column)
+    if column == 'date':
+        return lambda item: catalog.parse_date(item[index])
+    return lambda item: catalog.to_int(item[index])
+
+
+def top_items(items, limit, order, words_contains):
+    """First limit items in order, keeps only limit items in memory"""
+    select = heapq.nsmallest if catalog.split_order(order)[1] else heapq.nlargest
+    return select(limit, items, key=rank_key(order, words_contains))
+
+
+def ranked(items, limit, order, words_contains):
+    yield from top_items(items, limit, order, words_contains)
+
+
+def scan_chunk(filename, words_contains, words_not_contains, words_category, limit, order=default_order):
+    with bz2.open(filename, 'rt', encoding='utf8') as f:
+        if order == default_order:
+            return list(scan_lines(f, words_contains, words_not_contains, words_category, limit))
+        return top_items(scan_lines(f, words_contains, words_not_contains, words_category, float('inf')), limit, order,
+                         words_contains)
+
+
+def parallel_scan(words_contains, words_not_contains, words_category, limit, order=default_order,
+                  folder=chunks_folder, cancel=None):
+    """Scan table chunks in a process pool, yield matches in order.
+
+    Only a window of chunks is scheduled ahead of the one being merged, so
+    in table (seeds) order nothing more is scanned once limit is reached.
+    For other orders every chunk gives its top limit rows and they are
+    merged into the top of all. cancel (threading.Event) stops the scan
+    between chunks, chunks not started yet are cancelled.
+    """
+    words_contains = [w.lower() for w in words_contains]
+    words_not_contains = [w.lower() for w in words_not_contains]
+    words_category = [w.lower() for w in words_category]
+
+    executor = get_executor()
+    files = chunk_files(folder)
+    window = 2 * (os.cpu_count() or 1)
+    pending = []
+    next_file = 0
+    founded_items = 0
+    best = []
+    try:
+        while next_file < len(files) or pending:
+            while next_file < len(files) and len(pending) < window:
+                pending.append(executor.submit(scan_chunk, files[next_file], words_contains, words_not_contains,
+                                               words_category, limit, order))
+                next_file += 1
+            if cancel is not None:
+                # waiting in steps, a query without matches is stopped too
+                while not futures.wait(pending[:1], timeout=0.1).done and not cancel.is_set():
+                    pass
+                if cancel.is_set():
+                    return
+            items = pending.pop(0).result()
+            if order != default_order:
+                best = top_items(best + items, limit, order, words_contains)
+                continue
+            for item in items:
+                yield item
+                founded_items += 1
+                if founded_items >= limit:
+                    return
+        yield from best
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def catalog_scan(words_contains, words_not_contains, words_category, limit, order=default_order,
+                 filename=catalog.catalog_file, cancel=None, category_id=None):
+    db = catalog.Catalog(filename, readonly=True)
+    if cancel is not None:
+        # sqlite calls it every 10000 steps of the query, true - query is interrupted
+        db.db.set_progress_handler(cancel.is_set, 10000)
+    try:
+        yield from db.search(words_contains, words_not_contains, words_category, limit, order, category_id)
+    except sqlite3.OperationalError:
+        if cancel is None or not cancel.is_set():
+            raise
+    finally:
+        db.close()
+
+
+def categories():
+    """Category tree with counts (see Catalog.category_tree) or None without catalog"""
+    if not os.path.isfile(catalog.catalog_file):
+        return None
+    db = catalog.Catalog(catalog.catalog_file, readonly=True)
+    try:
+        return db.category_tree()
+    finally:
+        db.close()
+
+
+def normalize_query(words_contains, words_not_contains, words_category, order=default_order, category_id=None):
+    return (frozenset(w.lower() for w in words_contains),
+            frozenset(w.lower() for w in words_not_contains),
+            frozenset(w.lower() for w in words_category),
+            order, category_id)
+
+
+class QueryCache:
+    """Results of previous searches keyed by normalized query.
+
+    Entries are evicted in LRU order once their estimated size goes over
+    max_bytes. A query that only adds words or exclusions to a cached one is
+    answered by filtering the cached rows instead of rescanning the table.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()  # key -> (items, complete, size)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def estimate_size(items):
+        size = sys.getsizeof(items)
+        for item in items:
+            size += sys.getsizeof(item) + sum(sys.getsizeof(value) for value in item)
+        return size
+
+    def put(self, key, items, complete):
+        """complete - the scan went through the whole table, items is every match"""
+        with self.lock:
+            self._put(key, items, complete)
+
+    def _put(self, key, items, complete):
+        self.remove(key)
+        size = self.estimate_size(items)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (items, complete, size)
+        self.used_bytes += size
+        while self.used_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        if key in self.entries:
+            self.used_bytes -= self.entries.pop(key)[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.used_bytes = 0
+
+    def get(self, key, limit):
+        """Return first limit matches for key or None if the cache can't answer."""
+        with self.lock:
+            return self._get(key, limit)
+
+    def _get(self, key, limit):
+        words_contains, words_not_contains, words_category, order, category_id = key
+        best = None
+        for cached_key, (items, complete, size) in self.entries.items():
+            # rows don't carry category id, rows of other subtree can't be filtered
+            if not (cached_key[0] <= words_contains and cached_key[1] <= words_not_contains
+                    and cached_key[2] <= words_category and cached_key[3] == order
+                    and cached_key[4] == category_id):
+                continue
+            if order.lstrip('-') == 'relevance' and cached_key != key:
+                # score depends on the words, rows of other query are in other order
+                continue
+            if cached_key == key:
+                best = cached_key
+                break
+            if best is None or len(items) < len(self.entries[best][0]):
+                best = cached_key
+        if best is None:
+            return None
+        items, complete, size = self.entries[best]
+        if best != key:
+            # refinement: every match of the new query is a match of the cached one
+            items = [item for item in items if match(item, words_contains, words_not_contains, words_category)]
+        # cached rows are the first matches in query order, so a prefix of the
+        # filtered rows is exact as long as it is long enough (or nothing was cut)
+        if not complete and len(items) < limit:
+            return None
+        self.entries.move_to_end(best)
+        if best != key:
+            self._put(key, items, complete)
+        return items[:limit]
+
+
+query_cache = QueryCache()
+
+
+def parse_query(text, category='', limit=default_limit):
+    """Split query into (words_contains, words_not_contains, words_category, limit, order).
+
+    'word' - include word, '-word' - exclude word, 'limit:5' - count of results,
+    'sort:date' - order by column, biggest first ('sort:-date' - smallest first),
+    one of catalog.sort_columns, 'sort:relevance' - matched words and seeds.
+    """
+    order = default_order
+    words_contains = []
+    words_not_contains = []
+    words_category = []
+    for w in text.split():
+        if (len(w) > 1) and (w[0]) == '-':
+            words_not_contains.append(w[1:])
+        elif (len(w) > len('limit:')) and (w[:6] == 'limit:'):
+            limit = int(w[6:])
+        elif (len(w) > len('sort:')) and (w[:5] == 'sort:'):
+            order = w[5:]
+            catalog.split_order(order)
+        else:
+            words_contains.append(w)
+    for w in category.split():
+        words_category.append(w)
+    return words_contains, words_not_contains, words_category, limit, order
+
+
+def search(text, category='', cache=query_cache, limit=default_limit, cancel=None, category_id=None):
+    """Yield rows (lists of column strings) matching query, sorted by seeds or 'sort:' of query.
+
+    limit - count of results if query has no 'limit:'
+    cancel - threading.Event, when set the search stops soon also if nothing is found
+    category_id - only rows of this catalog category and its subcategories (see categories())
+    """
+    words_contains, words_not_contains, words_category, limit, order = parse_query(text, category, limit)
+    key = normalize_query(words_contains, words_not_contains, words_category, order, category_id)
+    if cache is not None:
+        cached_items = cache.get(key, limit)
+        if cached_items is not None:
+            yield from cached_items
+            return
+
+    if os.path.isfile(catalog.catalog_file):
+        # indexed catalog (loader.py --sqlite or catalog.py import)
+        items = catalog_scan(words_contains, words_not_contains, words_category, limit, order, cancel=cancel,
+                             category_id=category_id)
+    elif category_id is not None:
+        raise ValueError('category id needs catalog (python3 ./catalog.py import)')
+    elif chunk_files():
+        # chunked table - scan all parts on all cores
+        items = parallel_scan(words_contains, words_not_contains, words_category, limit, order, cancel=cancel)
+    else:
+        archive = TarFile.open(table_archive, 'r:bz2')
+        member = archive.members[0]
+        buffered_text_reader = io.TextIOWrapper(archive.extractfile(member), encoding='utf8')
+        words_contains = [w.lower() for w in words_contains]
+        items = scan_lines(buffered_text_reader, words_contains, [w.lower() for w in words_not_contains],
+                           [w.lower() for w in words_category], limit if order == default_order else float('inf'),
+                           cancel)
+        if order != default_order:
+            items = ranked(items, limit, order, words_contains)
+
+    founded_items = []
+    try:
+        for item in items:
+            founded_items.append(item)
+            yield item
+    finally:
+        items.close()
+    # not reached when caller stopped reading - partial results are not cached
+    if cache is not None and not (cancel is not None and cancel.is_set()):
+        cache.put(key, founded_items, len(founded_items) < limit)
+
+
+def load_trackers(filename=trackers_file):
+    """Trackers from file (one per line, '#' - comment), default ones if there is no file"""
+    if not os.path.isfile(filename):
+        return default_trackers
+    lines = (line.split('#', 1)[0].strip() for line in open(filename, encoding='utf8'))
+    return tuple(line for line in lines if line)
+
+
+_tracker_params = {}
+
+
+def tracker_params(tracker_list):
+    # quoted once for all links
+    if tracker_list not in _tracker_params:
+        _tracker_params[tracker_list] = ''.join('&tr=' + urllib.parse.quote(tracker, safe='')
+                                                for tracker in tracker_list)
+    return _tracker_params[tracker_list]
+
+
+def magnet_link(hash, name, tracker_list=None):
+    """hash - hex text or 20 bytes, tracker_list - tuple, trackers.txt (or default ones) if None"""
+    global trackers
+    if tracker_list is None:
+        if trackers is None:
+            trackers = load_trackers()
+        tracker_list = trackers
+    if isinstance(hash, bytes):
+        hash = hash.hex().upper()
+    return 'magnet:?xt=urn:btih:' + hash + '&dn=' + urllib.parse.quote(name, safe='') + tracker_params(tracker_list)
+
+
+def write_magnets(items, f, tracker_list=None):
+    """Write magnet link of every row (one per line) as rows come, return count"""
+    count = 0
+    hash_column = columns.index('hash')
+    for item in items:
+        f.write(magnet_link(item[hash_column], item[name_column], tracker_list) + '\n')
+        count += 1
+    return count
+
+
+def item_to_dict(item):
+    row = dict(zip(columns, item))
+    for column in ('id', 'size', 'seeds', 'peers', 'downloads'):
+        if column in row:
+            row[column] = int(row[column])
+    row['magnet'] = magnet_link(row['hash'], row['name'])
+    return row
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path == '/categories':
+            try:
+                tree = categories()
+            except catalog.OldCatalogError as e:
+                self.send_error(503, 'old catalog', str(e))
+                return
+            if tree is None:
+                self.send_error(404, 'no catalog')
+                return
+            body = json.dumps({'categories': tree}, ensure_ascii=False).encode()
+        elif url.path == '/search':
+            params = urllib.parse.parse_qs(url.query)
+            text = params.get('q', [''])[0]
+            category = params.get('category', [''])[0]
+            try:
+                results = [item_to_dict(item) for item in search(text, category,
+                                                                 category_id=query_category_id(params))]
+            except catalog.OldCatalogError as e:
+                self.send_error(503, 'old catalog', str(e))
+                return
+            except ValueError:
+                self.send_error(400, 'bad query')
+                return
+            body = json.dumps({'query': text, 'category': category, 'results': results}, ensure_ascii=False).encode()
+        elif url.path == '/magnets':
+            params = urllib.parse.parse_qs(url.query)
+            try:
+                # all results unless query has 'limit:', not cached
+                items = search(params.get('q', [''])[0], params.get('category', [''])[0], None, sys.maxsize,
+                               category_id=query_category_id(params))
+                first = next(items, None)
+            except catalog.OldCatalogError as e:
+                self.send_error(503, 'old catalog', str(e))
+                return
+            except ValueError:
+                self.send_error(400, 'bad query')
+                return
+            # length is not known, response ends with connection
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            if first is not None:
+                writer = io.TextIOWrapper(self.wfile, encoding='utf8', write_through=True)
+                write_magnets(itertools.chain([first], items), writer)
+                writer.detach()
+            return
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def query_category_id(params):
+    # ValueError of not a number is a bad query too
+    return int(params['category_id'][0]) if 'category_id' in params else None
+
+
+def serve(host, port):
+    server = ThreadingHTTPServer((host, port), SearchRequestHandler)
+    print('serving on http://%s:%i/search?q=...' % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def write_chunks(lines, folder=chunks_folder, rows=chunk_rows):
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    for name in os.listdir(folder):
+        if name.endswith('.bz2'):
+            os.remove(os.path.join(folder, name))
+    chunk = io.StringIO()
+    count = 0
+    number = 0
+    for line in lines:
+        chunk.write(line)
+        count += 1
+        if count >= rows:
+            with bz2.open(os.path.join(folder, '%05i.bz2' % number), 'wt', encoding='utf8') as f:
+                f.write(chunk.getvalue())
+            chunk = io.StringIO()
+            count = 0
+            number += 1
+    if count:
+        with bz2.open(os.path.join(folder, '%05i.bz2' % number), 'wt', encoding='utf8') as f:
+            f.write(chunk.getvalue())
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser(description='search through local copy of rutracker')
+    ap.add_argument('query', nargs='*', help="'word', '-word', 'limit:5'")
+    ap.add_argument('--category', '-c', default='')
+    ap.add_argument('--category-id', type=int, help='rows of catalog category and its subcategories '
+                                                    '(ids from --categories --json)')
+    ap.add_argument('--json', action="store_true", help='print results as json lines')
+    ap.add_argument('--categories', action="store_true", help='print category tree with counts (needs catalog)')
+    ap.add_argument('--magnets', action="store_true", help="print only magnet links, of all results without 'limit:'")
+    ap.add_argument('--trackers', metavar='FILE', default=trackers_file, help='trackers for magnet links, one per line')
+    ap.add_argument('--serve', type=int, metavar='PORT', help='run http server with /search?q=...&category=...')
+    ap.add_argument('--host', default='127.0.0.1')
+    options = ap.parse_args()
+
+    trackers = load_trackers(options.trackers)
+    if options.serve:
+        serve(options.host, options.serve)
+    else:
+        try:
+            if options.categories:
+                for category in categories() or []:
+                    if options.json:
+                        print(json.dumps(category, ensure_ascii=False))
+                    else:
+                        indent = '    ' * category['path'].count(catalog.category_separator)
+                        print('%8i  %s%s' % (category['total'], indent, category['name']))
+            elif options.magnets:
+                write_magnets(search(' '.join(options.query), options.category, None, sys.maxsize,
+                                     category_id=options.category_id), sys.stdout)
+            else:
+                for item in search(' '.join(options.query), options.category, category_id=options.category_id):
+                    row = item_to_dict(item)
+                    if options.json:
+                        print(json.dumps(row, ensure_ascii=False))
+                    else:
+                        print('%(id)8i  %(seeds)6i  %(name)s\n          %(magnet)s' % row)
+        except ValueError as e:
+            # old catalog, unknown 'sort:' column, 'limit:' not a number
+            ap.exit(1, '%s\n' % e)
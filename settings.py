@@ -5,6 +5,12 @@ import os
 import random
 import logging
 import json
+import time
+from proxycheck import ProxyProber, rank
+import planner
+import descrstore
+import catalog
+import record
 
 class Settings:
     def __init__(self):
@@ -22,15 +28,30 @@ class Settings:
         ap.add_argument('--password', '-pw')
         # ap.add_argument('--html')
         ap.add_argument('--folder', '-f')
+        ap.add_argument('--dedup', action="store_true")
+        ap.add_argument('--sqlite', nargs='?', const=catalog.catalog_file)
+        ap.add_argument('--profile', nargs='?', const='profile')
         # ap.add_argument('--cookie')
         # ap.add_argument('--cookies_list')
         ap.add_argument('--random', action="store_true")
+        ap.add_argument('--plan', nargs='?', const='.')
+        ap.add_argument('--shard')
+        ap.add_argument('--block_size', type=int)
         ap.add_argument('--threads', '-tr', type=int)
+        ap.add_argument('--workers', choices=('process', 'thread'))
         ap.add_argument('--proxy_file', '-pf', '-pr')
         ap.add_argument('--login_file', '-lf')
         ap.add_argument('--restore', '--resume', action="store_true")
         ap.add_argument('--print', action="store_true")
         ap.add_argument('--qsize', '-q', type=int)
+        ap.add_argument('--warm', type=int)
+        ap.add_argument('--spool_above', type=int)
+        ap.add_argument('--result_budget', type=int)
+        ap.add_argument('--probe', action="store_true")
+        ap.add_argument('--cookie_age', type=int)
+        ap.add_argument('--probe_target')
+        ap.add_argument('--probe_ttl', type=int)
+        ap.add_argument('--probe_interval', type=int)
         self.options = ap.parse_args()
 
         self.login = self.options.user if self.options.user else ''
@@ -40,16 +61,50 @@ class Settings:
         self.ids_ignore = self.options.ids_ignore if self.options.ids_ignore else ''
         self.restore = True if self.options.restore else False
         self.random = True if self.options.random else False
+        self.plan_folder = self.options.plan if self.options.plan else ''
+        self.plan = None
+        self.ids_skipped = 'skipped.txt'
+        self.shard = None
+        if self.options.shard:
+            try:
+                self.shard = tuple(map(int, self.options.shard.split('/')))
+            except ValueError:
+                ap.error('--shard must be index/count, e.g. 0/4')
+            if len(self.shard) != 2 or not 0 <= self.shard[0] < self.shard[1]:
+                ap.error('--shard index/count needs 0 <= index < count, got %s' % self.options.shard)
+        self.block_size = int(self.options.block_size) if self.options.block_size else 1000
         self.print = True if self.options.print else False
         self.noproxy = True if self.options.noproxy else False
         # self.html_folder = self.options.html if self.options.html else 'html'
         self.threads_num = int(self.options.threads) if self.options.threads else 1
+        self.workers_mode = self.options.workers if self.options.workers else 'process'
         self.descr_folder = self.options.folder if self.options.folder else 'descr'
+        self.dedup = True if self.options.dedup else False
+        self.descr_store = None
+        self.catalog_file = self.options.sqlite if self.options.sqlite else ''
+        self.catalog = None
+        self.profile_folder = self.options.profile if self.options.profile else ''
         self.proxy_file = self.options.proxy_file if self.options.proxy_file else 'proxy.txt'
         self.login_file = self.options.login_file if self.options.login_file else 'login.txt'
         self.proxy_port = int(self.options.port) if self.options.port else 9150
-        self.qsize = int(self.options.qsize) if self.options.qsize else min((self.threads_num + 2), 30)
-        self.table_file = "table.txt"
+        # upper bound of queued tasks, else sized by measured latency (flowcontrol.py)
+        self.qsize = int(self.options.qsize) if self.options.qsize else None
+        self.warm_connections = int(self.options.warm) if self.options.warm else 0
+        # descriptions above spool_above bytes are written by workers to spool folder, only file name is returned
+        self.spool_folder = os.path.join(self.descr_folder, 'spool')
+        self.spool_above = int(self.options.spool_above) if self.options.spool_above is not None else 65536
+        # MB of descriptions in results in flight, tasks in flight are limited by it
+        self.result_budget = int(self.options.result_budget) if self.options.result_budget else 64
+        self.max_results_in_flight = max(1, self.result_budget * 2 ** 20 // max(1, self.spool_above))
+        self.cookie_max_age = int(self.options.cookie_age) if self.options.cookie_age else 12 * 3600
+        self.probe = True if self.options.probe else False
+        self.probe_target = self.options.probe_target if self.options.probe_target else 'https://rutracker.org/forum/index.php'
+        self.probe_ttl = int(self.options.probe_ttl) if self.options.probe_ttl else 3600
+        self.probe_interval = int(self.options.probe_interval) if self.options.probe_interval else 600
+        self.probe_file = 'proxy_probe.json'
+        self.prober = None
+        self.probe_nexttime = 0
+        self.table_file = "table.bin"
         self.ids_finished = 'finished.txt'
 
         useragents = ['Mozilla/5.0 (Android; Mobile; rv:38.0) Gecko/38.0 Firefox/38.0',
@@ -84,6 +139,9 @@ class Settings:
         self.handle_finished_file = 0
 
         self.temp_cookies_filename = 'temp_cookies.txt'
+        self.cookie_owners = dict()  # cookie -> username, includes replaced cookies
+        self.cookies_changed = False
+        self.cookies_flush_nexttime = 0
 
         self.log.debug("end loading settings")
 
@@ -107,9 +165,14 @@ class Settings:
             random.shuffle(self.proxy_list)
             self.log.info("loaded %i proxies from file" % len(self.proxy_list))
         else: #len(self.proxy_list) == 0:
-            self.proxy_list = list({'ip': '127.0.0.1', 'port': int(self.proxy_port)})
+            self.proxy_list = [{'ip': '127.0.0.1', 'port': int(self.proxy_port), 'in_use': 0, 'fails': 0}]
             self.log.info("loaded single proxy - 127.0.0.1:%s" % str(self.proxy_port))
 
+        if self.probe and not self.noproxy:
+            self.prober = ProxyProber(self.probe_target, ttl=self.probe_ttl, cache_file=self.probe_file)
+            self.apply_probe_results(self.prober.probe([(proxy['ip'], proxy['port']) for proxy in self.proxy_list]))
+            self.probe_nexttime = time.time() + self.probe_interval
+
         if self.login and self.password:
             self.login_list.append({'username': self.login, 'password': self.password, 'in_use': 0, 'fails': 0})
             self.log.info("loaded 1 login")
@@ -161,8 +224,19 @@ class Settings:
             self.log.info('left:    \t%i' % len(ids_new))
             self.ids = ids_new
 
-        if self.random:
+        if self.shard:
+            self.log.debug("selecting ids of shard %i/%i" % self.shard)
+            self.ids = [id for id in self.ids if planner.in_shard(id, self.shard, self.block_size)]
+
+        if self.plan_folder:
+            self.log.debug("ordering ids by previous crawl in '%s'" % self.plan_folder)
+            stats = planner.block_stats(self.plan_folder, self.block_size)
+            self.plan = planner.Plan(self.ids, stats, self.block_size)
+            # rest of sampled blocks is added by coordinator as samples are answered
+            self.ids = self.plan.ids
+        elif self.random:
             self.log.debug("shuffle ids")
+            self.ids = list(self.ids)
             random.shuffle(self.ids)
 
         self.ids = list(self.ids)
@@ -171,15 +245,44 @@ class Settings:
 
     def open_files(self):
         self.log.debug("opening files to write results")
-        self.handle_table_file = open(self.table_file, 'a', encoding='utf8')
+        if record.repair(self.table_file):
+            self.log.warning('incomplete last record removed from %s' % self.table_file)
+        self.handle_table_file = open(self.table_file, 'ab')
         self.handle_finished_file = open(self.ids_finished, 'a', encoding='utf8')
+        # descriptions spooled by previous run, their ids are not finished and will be loaded again
+        os.makedirs(self.spool_folder, exist_ok=True)
+        for name in os.listdir(self.spool_folder):
+            os.remove(os.path.join(self.spool_folder, name))
+        if self.dedup:
+            self.descr_store = descrstore.open_store(self.descr_folder, readonly=False)
+        if self.catalog_file:
+            self.catalog = catalog.Catalog(self.catalog_file)
         # log_file = open('log.txt', 'a', encoding='utf8')
 
+    def flush_files(self):
+        """Write buffered results, rows before finished ids (resume must not skip a lost row)"""
+        if not self.handle_table_file:
+            return
+        self.handle_table_file.flush()
+        if self.catalog:
+            self.catalog.flush()
+        self.handle_finished_file.flush()
+
     def close_files(self):
         self.log.debug("closing files with results")
+        self.flush_cookies(force=True)
         self.handle_table_file.close()
         # log_file.close()
         self.handle_finished_file.close()
+        if self.descr_store:
+            self.descr_store.close()
+        if self.catalog:
+            self.catalog.close()
+        if self.plan and self.plan.skipped:
+            # blocks where samples found nothing, can be crawled later by --ids_file
+            with open(self.ids_skipped, 'a', encoding='utf8') as f:
+                f.writelines('%i\n' % id for id in self.plan.skipped)
+            self.log.info('%i ids of blocks without torrents skipped, see %s' % (len(self.plan.skipped), self.ids_skipped))
 
     def load_cookies(self):
         self.log.debug("load_cookies start")
@@ -190,21 +293,80 @@ class Settings:
                     for i in range(len(self.login_list)):
                         if self.login_list[i]['username'] == item['username']:
                             self.login_list[i]['cookie'] = item['cookie']
+                            # cookies saved by older versions have unknown age - refresh them soon
+                            self.login_list[i]['cookie_time'] = item.get('cookie_time', 0)
+                            self.cookie_owners[item['cookie']] = item['username']
                             break
         self.log.debug("load_cookies done")
         self.log.debug("cookies: %s" % str(self.login_list))
 
     def save_cookies(self):
+        # only marks cookies as changed, they are written by flush_cookies
+        self.cookies_changed = True
+
+    def flush_cookies(self, force=False):
+        if not self.cookies_changed or (not force and time.time() < self.cookies_flush_nexttime):
+            return
         self.log.debug("save_cookies")
-        json.dump(self.login_list, open(self.temp_cookies_filename, 'w'))
+        self.cookies_changed = False
+        self.cookies_flush_nexttime = time.time() + 10
+        fields = ('username', 'password', 'cookie', 'cookie_time')
+        temp_login_list = [{key: login[key] for key in fields if key in login} for login in self.login_list]
+        temp_filename = self.temp_cookies_filename + '.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(temp_login_list, f)
+        os.replace(temp_filename, self.temp_cookies_filename)
+
+    def get_login(self, cookie):
+        username = self.cookie_owners.get(cookie)
+        for login in self.login_list:
+            if login['username'] == username:
+                return login
+        return None
 
     def set_cookie(self, username, cookie):
         for i in range(len(self.login_list)):
             if self.login_list[i]['username'] == username:
                 self.login_list[i]['cookie'] = cookie
+                self.login_list[i]['cookie_time'] = time.time()
+                self.login_list[i]['fails'] = 0
+                self.login_list[i]['refreshing'] = False
+                self.cookie_owners[cookie] = username
                 break
         self.save_cookies()
 
+    def set_cookie_refresh_error(self, username):
+        for login in self.login_list:
+            if login['username'] == username:
+                login['refreshing'] = False
+                login['refresh_nexttime'] = time.time() + 60
+
+    def logins_to_refresh(self):
+        """Logins which need new cookie: without cookie, old cookie or many errors.
+
+        Old cookie stays in use until new one is set, so workers don't wait.
+        Returned logins are marked as refreshing until set_cookie or
+        set_cookie_refresh_error is called for them.
+        """
+        now = time.time()
+        result = []
+        for login in self.login_list:
+            if login.get('refreshing') or now < login.get('refresh_nexttime', 0):
+                continue
+            if (not login.get('cookie')) or (now - login.get('cookie_time', 0) > self.cookie_max_age * 0.8) or \
+                    (login['fails'] >= 3):
+                login['refreshing'] = True
+                result.append(login)
+        return result
+
+    def lease_capacity(self):
+        """How many tasks can hold a proxy and a cookie at the same time"""
+        cookies = self.threads_per_cookie * len([login for login in self.login_list if login.get('cookie')])
+        if self.noproxy:
+            return cookies
+        proxies = self.threads_per_proxy * len([proxy for proxy in self.proxy_list if not proxy.get('dead')])
+        return min(cookies, proxies)
+
     def get_free_cookie(self):
         not_using_logins = [login for login in self.login_list if (login['in_use'] < self.threads_per_cookie) and ('cookie' in login.keys()) and login['cookie']!='']
         if len(not_using_logins) == 0:
@@ -213,35 +375,57 @@ class Settings:
         selected_login = min(not_using_logins, key=lambda login: login['fails'])
         # if selected_login['fails'] > 10:
         #     return None
-        cookie = selected_login['cookie']
-        i = [i for i,login in enumerate(self.login_list) if ('cookie' in login.keys()) and (login['cookie'] == cookie)][0]
-        self.login_list[i]['in_use'] += 1
-        return cookie
+        selected_login['in_use'] += 1
+        return selected_login['cookie']
 
     def set_free_cookie(self, cookie):
-        ii = [i for i,login in enumerate(self.login_list) if ('cookie' in login.keys()) and (login['cookie'] == cookie)]
-        if len(ii) > 0:
-            i = ii[0]
-            self.login_list[i]['in_use'] -= 1
+        # cookie may be replaced already, login is found by any of its cookies
+        login = self.get_login(cookie)
+        if login:
+            login['in_use'] -= 1
 
     def set_error_cookie(self, cookie):
         self.log.debug('set_error_cookie, cookie: %s' % cookie)
         self.log.debug(self.login_list)
-        i = [i for i,login in enumerate(self.login_list) if ('cookie' in login.keys()) and (login['cookie'] == cookie)][0]
-        self.login_list[i]['fails'] += 1
-        if self.login_list[i]['fails'] > 5:
-            self.login_list[i]['cookie'] = ''
+        login = self.get_login(cookie)
+        if not login or login.get('cookie') != cookie:
+            return  # cookie was replaced already
+        login['fails'] += 1
+        if login['fails'] > 5:
+            login['cookie'] = ''
             self.save_cookies()
             self.log.warning('cookie removed from pool (too many fails)')
 
+    def apply_probe_results(self, results):
+        # dead proxies are kept in list (they can be in use), but not given out
+        ranked = {key: i for i, key in enumerate(rank(results))}
+        for proxy in self.proxy_list:
+            key = ProxyProber.key(proxy['ip'], proxy['port'])
+            proxy['dead'] = key not in ranked
+            proxy['latency'] = results[key]['latency'] if key in ranked else None
+        self.proxy_list.sort(key=lambda p: ranked.get(ProxyProber.key(p['ip'], p['port']), len(ranked)))
+        self.log.info("proxies probed: %i alive, %i dead" % (len(ranked), len(self.proxy_list) - len(ranked)))
+
+    def check_proxies(self):
+        # periodic probe in background, called from main loop
+        if not self.prober:
+            return
+        results = self.prober.results()
+        if results:
+            self.apply_probe_results(results)
+        if time.time() > self.probe_nexttime:
+            self.probe_nexttime = time.time() + self.probe_interval
+            self.prober.start([(proxy['ip'], proxy['port']) for proxy in self.proxy_list])
+
     def get_free_proxy(self):
         if self.noproxy:
             return {'ip':'', 'port': -1}
-        not_using_proxies = [proxy for proxy in self.proxy_list if proxy['in_use'] < self.threads_per_proxy]
+        not_using_proxies = [proxy for proxy in self.proxy_list if proxy['in_use'] < self.threads_per_proxy and not proxy.get('dead')]
         random.shuffle(not_using_proxies)
         if len(not_using_proxies) == 0:
             return None
-        selected_proxy = min(not_using_proxies, key=lambda p: p['fails'])
+        # probed latency (if any) decides between proxies with same fails
+        selected_proxy = min(not_using_proxies, key=lambda p: (p['fails'], p.get('latency') or 0))
         if selected_proxy['fails'] > 1000:
             self.log.debug('none free proxy')
             return None
@@ -40,17 +40,25 @@ mainly to merge bug fixes found in Sourceforge
 
 """
 
+import asyncio
 import socket
 import struct
 import sys
+import threading
 
 PROXY_TYPE_SOCKS4 = 1
 PROXY_TYPE_SOCKS5 = 2
 PROXY_TYPE_HTTP = 3
 
 _defaultproxy = None
+_threadproxy = threading.local()
 _orgsocket = socket.socket
 
+# Send SOCKS5 connection request together with the greeting when
+# no authentication is used. Set to False for proxies which can't
+# handle a request sent before their reply to the greeting.
+pipeline_socks5 = True
+
 class ProxyError(Exception): pass
 class GeneralProxyError(ProxyError): pass
 class Socks5AuthError(ProxyError): pass
@@ -96,6 +104,22 @@ def setdefaultproxy(proxytype=None, addr=None, port=None, rdns=True, username=No
     global _defaultproxy
     _defaultproxy = (proxytype, addr, port, rdns, username, password)
 
+def setthreadproxy(proxytype=None, addr=None, port=None, rdns=True, username=None, password=None):
+    """setthreadproxy(proxytype, addr[, port[, rdns[, username[, password]]]])
+    Same as setdefaultproxy, but only for sockets created by the calling
+    thread. Overrides the default proxy, call without arguments to go back
+    to it.
+    """
+    if proxytype == None and addr == None:
+        _threadproxy.proxy = None
+    else:
+        _threadproxy.proxy = (proxytype, addr, port, rdns, username, password)
+
+def getdefaultproxy():
+    """getdefaultproxy() -> proxy used by new sockets of the calling thread"""
+    proxy = getattr(_threadproxy, 'proxy', None)
+    return proxy if proxy != None else _defaultproxy
+
 def wrapmodule(module):
     """wrapmodule(module)
     Attempts to replace a module's socket library with a SOCKS socket. Must set
@@ -115,26 +139,30 @@ class socksocket(socket.socket):
     you must specify family=AF_INET, type=SOCK_STREAM and proto=0.
     """
 
-    def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0, _sock=None):
-        _orgsocket.__init__(self, family, type, proto, _sock)
-        if _defaultproxy != None:
-            self.__proxy = _defaultproxy
+    def __init__(self, family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0, _sock=None, fileno=None):
+        # fileno - keyword used by socket.accept() once socket.socket is replaced
+        _orgsocket.__init__(self, family, type, proto, fileno if fileno != None else _sock)
+        if getdefaultproxy() != None:
+            self.__proxy = getdefaultproxy()
         else:
             self.__proxy = (None, None, None, None, None, None)
         self.__proxysockname = None
         self.__proxypeername = None
 
-    def __recvall(self, count):
-        """__recvall(count) -> data
-        Receive EXACTLY the number of bytes requested from the socket.
+    def __recvall(self, count, buf=None, offset=0):
+        """__recvall(count[, buf[, offset]]) -> buf
+        Receive EXACTLY the number of bytes requested from the socket
+        into buf at offset (a new bytearray if buf is not given).
         Blocks until the required number of bytes have been received.
         """
-        data = self.recv(count)
-        while len(data) < count:
-            d = self.recv(count-len(data))
-            if not d: raise GeneralProxyError((0, "connection closed unexpectedly"))
-            data = data + d
-        return data
+        if buf is None:
+            buf = bytearray(count)
+        view = memoryview(buf)[offset:offset + count]
+        while view:
+            received = self.recv_into(view)
+            if not received: raise GeneralProxyError((0, "connection closed unexpectedly"))
+            view = view[received:]
+        return buf
 
     def setproxy(self, proxytype=None, addr=None, port=None, rdns=True, username=None, password=None):
         """setproxy(proxytype, addr[, port[, rdns[, username[, password]]]])
@@ -159,36 +187,67 @@ class socksocket(socket.socket):
         """__negotiatesocks5(self,destaddr,destport)
         Negotiates a connection through a SOCKS5 server.
         """
-        # First we'll send the authentication packages we support.
+        # Build the connection request first, so it can be sent
+        # together with the greeting.
+        req = bytearray(b'\x05\x01\x00')
+        # If the given destination address is an IP address, we'll
+        # use the IPv4 address request even if remote resolving was specified.
+        try:
+            ipaddr = socket.inet_aton(destaddr)
+            req += b'\x01' + ipaddr
+        except socket.error:
+            # Well it's not an IP number,  so it's probably a DNS name.
+            if self.__proxy[3]:
+                # Resolve remotely
+                ipaddr = None
+                hostname = destaddr.encode('idna')
+                req += struct.pack('BB', 0x03, len(hostname)) + hostname
+            else:
+                # Resolve locally
+                ipaddr = socket.inet_aton(socket.gethostbyname(destaddr))
+                req += b'\x01' + ipaddr
+        req += struct.pack(">H", destport)
+        # All replies are read into one buffer: 2 bytes of the chosen
+        # method, 4 bytes of the reply header, up to 16 bytes of the
+        # bound address (IPv6, or 1 + 255 for a DNS name) and 2 of the port.
+        resp = bytearray(2 + 4 + 1 + 255 + 2)
         if (self.__proxy[4]!=None) and (self.__proxy[5]!=None):
             # The username/password details were supplied to the
             # setproxy method so we support the USERNAME/PASSWORD
             # authentication (in addition to the standard none).
-            self.sendall(struct.pack('BBBB', 0x05, 0x02, 0x00, 0x02))
+            self.sendall(b'\x05\x02\x00\x02')
+            pipelined = False
+        elif pipeline_socks5:
+            # Only "no authentication" is offered, so the server can't
+            # pick anything else - send the request without waiting
+            # for the reply to the greeting (saves one round trip).
+            self.sendall(b'\x05\x01\x00' + req)
+            pipelined = True
         else:
-            # No username/password were entered, therefore we
-            # only support connections with no authentication.
-            self.sendall(struct.pack('BBB', 0x05, 0x01, 0x00))
+            self.sendall(b'\x05\x01\x00')
+            pipelined = False
         # We'll receive the server's response to determine which
         # method was selected
-        chosenauth = self.__recvall(2)
-        if chosenauth[0:1] != chr(0x05).encode():
+        self.__recvall(2, resp)
+        if resp[0] != 0x05:
             self.close()
             raise GeneralProxyError((1, _generalerrors[1]))
         # Check the chosen authentication method
-        if chosenauth[1:2] == chr(0x00).encode():
+        if resp[1] == 0x00:
             # No authentication is required
             pass
-        elif chosenauth[1:2] == chr(0x02).encode():
+        elif resp[1] == 0x02 and not pipelined:
             # Okay, we need to perform a basic username/password
             # authentication.
-            self.sendall(chr(0x01).encode() + chr(len(self.__proxy[4])) + self.__proxy[4] + chr(len(self.__proxy[5])) + self.__proxy[5])
+            username = self.__proxy[4].encode() if isinstance(self.__proxy[4], str) else self.__proxy[4]
+            password = self.__proxy[5].encode() if isinstance(self.__proxy[5], str) else self.__proxy[5]
+            self.sendall(struct.pack('BB', 0x01, len(username)) + username + struct.pack('B', len(password)) + password)
             authstat = self.__recvall(2)
-            if authstat[0:1] != chr(0x01).encode():
+            if authstat[0] != 0x01:
                 # Bad response
                 self.close()
                 raise GeneralProxyError((1, _generalerrors[1]))
-            if authstat[1:2] != chr(0x00).encode():
+            if authstat[1] != 0x00:
                 # Authentication failed
                 self.close()
                 raise Socks5AuthError((3, _socks5autherrors[3]))
@@ -196,51 +255,42 @@ class socksocket(socket.socket):
         else:
             # Reaching here is always bad
             self.close()
-            if chosenauth[1] == chr(0xFF).encode():
+            if resp[1] == 0xFF:
                 raise Socks5AuthError((2, _socks5autherrors[2]))
             else:
                 raise GeneralProxyError((1, _generalerrors[1]))
         # Now we can request the actual connection
-        req = struct.pack('BBB', 0x05, 0x01, 0x00)
-        # If the given destination address is an IP address, we'll
-        # use the IPv4 address request even if remote resolving was specified.
-        try:
-            ipaddr = socket.inet_aton(destaddr)
-            req = req + chr(0x01).encode() + ipaddr
-        except socket.error:
-            # Well it's not an IP number,  so it's probably a DNS name.
-            if self.__proxy[3]:
-                # Resolve remotely
-                ipaddr = None
-                req = req + chr(0x03).encode() + chr(len(destaddr)).encode() + destaddr
-            else:
-                # Resolve locally
-                ipaddr = socket.inet_aton(socket.gethostbyname(destaddr))
-                req = req + chr(0x01).encode() + ipaddr
-        req = req + struct.pack(">H", destport)
-        self.sendall(req)
-        # Get the response
-        resp = self.__recvall(4)
-        if resp[0:1] != chr(0x05).encode():
+        if not pipelined:
+            self.sendall(req)
+        # Get the response header and the first byte of the bound address
+        self.__recvall(5, resp, 2)
+        if resp[2] != 0x05:
             self.close()
             raise GeneralProxyError((1, _generalerrors[1]))
-        elif resp[1:2] != chr(0x00).encode():
+        elif resp[3] != 0x00:
             # Connection failed
             self.close()
-            if ord(resp[1:2])<=8:
-                raise Socks5Error((ord(resp[1:2]), _socks5errors[ord(resp[1:2])]))
+            if resp[3] <= 8:
+                raise Socks5Error((resp[3], _socks5errors[resp[3]]))
             else:
                 raise Socks5Error((9, _socks5errors[9]))
         # Get the bound address/port
-        elif resp[3:4] == chr(0x01).encode():
-            boundaddr = self.__recvall(4)
-        elif resp[3:4] == chr(0x03).encode():
-            resp = resp + self.recv(1)
-            boundaddr = self.__recvall(ord(resp[4:5]))
+        elif resp[5] == 0x01:
+            self.__recvall(3 + 2, resp, 7)
+            boundaddr = socket.inet_ntoa(resp[6:10])
+            portoffset = 10
+        elif resp[5] == 0x03:
+            self.__recvall(resp[6] + 2, resp, 7)
+            boundaddr = bytes(resp[7:7 + resp[6]])
+            portoffset = 7 + resp[6]
+        elif resp[5] == 0x04:
+            self.__recvall(15 + 2, resp, 7)
+            boundaddr = socket.inet_ntop(socket.AF_INET6, bytes(resp[6:22]))
+            portoffset = 22
         else:
             self.close()
             raise GeneralProxyError((1,_generalerrors[1]))
-        boundport = struct.unpack(">H", self.__recvall(2))[0]
+        boundport = struct.unpack_from(">H", resp, portoffset)[0]
         self.__proxysockname = (boundaddr, boundport)
         if ipaddr != None:
             self.__proxypeername = (socket.inet_ntoa(ipaddr), destport)
@@ -324,10 +374,26 @@ class socksocket(socket.socket):
         else:
             addr = destaddr
         self.sendall(("CONNECT " + addr + ":" + str(destport) + " HTTP/1.1\r\n" + "Host: " + destaddr + "\r\n\r\n").encode())
-        # We read the response until we get the string "\r\n\r\n"
-        resp = self.recv(1)
-        while resp.find("\r\n\r\n".encode()) == -1:
-            resp = resp + self.recv(1)
+        # We read the response until we get the string "\r\n\r\n".
+        # Data is peeked first, so nothing after the headers is consumed.
+        resp = bytearray()
+        while True:
+            peeked = self.recv(4096, socket.MSG_PEEK)
+            if not peeked: raise GeneralProxyError((0, "connection closed unexpectedly"))
+            tail = resp[-3:]
+            end = (tail + peeked).find(b'\r\n\r\n')
+            if end != -1:
+                count = end + 4 - len(tail)
+            elif len(peeked) > 3:
+                # keep last bytes unread, the terminator may be split
+                count = len(peeked) - 3
+            else:
+                count = 1
+            offset = len(resp)
+            resp.extend(bytes(count))
+            self.__recvall(count, resp, offset)
+            if end != -1:
+                break
         # We just need the first line to check if the connection
         # was successful
         statusline = resp.splitlines()[0].split(" ".encode(), 2)
@@ -380,3 +446,201 @@ class socksocket(socket.socket):
             _orgsocket.connect(self, (destpair[0], destpair[1]))
         else:
             raise GeneralProxyError((4, _generalerrors[4]))
+
+
+# asyncio client
+#
+# Same protocols as socksocket, but the handshake runs on the event loop,
+# so one loop can drive many proxied connections at once. The proxy is
+# given as a tuple (proxytype, addr, port, rdns, username, password) like
+# the arguments of setdefaultproxy, the default proxy is used when omitted.
+#
+#   reader, writer = await socks.open_connection('rutracker.org', 443,
+#       proxy=(socks.PROXY_TYPE_SOCKS5, '127.0.0.1', 9150), ssl=True)
+#
+# create_connection() returns the connected socket itself, for clients
+# which take a ready socket, e.g. loop.create_connection(factory, sock=sock,
+# ssl=context, server_hostname=host).
+
+async def _arecvall(loop, sock, count, buf=None, offset=0):
+    """Receive EXACTLY count bytes into buf at offset (a new bytearray if buf is not given)."""
+    if buf is None:
+        buf = bytearray(count)
+    view = memoryview(buf)[offset:offset + count]
+    while view:
+        received = await loop.sock_recv_into(sock, view)
+        if not received: raise GeneralProxyError((0, "connection closed unexpectedly"))
+        view = view[received:]
+    return buf
+
+def _tobytes(value):
+    return value.encode() if isinstance(value, str) else value
+
+async def _anegotiatesocks5(loop, sock, proxy, destaddr, destport):
+    req = bytearray(b'\x05\x01\x00')
+    try:
+        req += b'\x01' + socket.inet_aton(destaddr)
+    except socket.error:
+        if proxy[3]:
+            hostname = destaddr.encode('idna')
+            req += struct.pack('BB', 0x03, len(hostname)) + hostname
+        else:
+            info = await loop.getaddrinfo(destaddr, destport, family=socket.AF_INET, type=socket.SOCK_STREAM)
+            req += b'\x01' + socket.inet_aton(info[0][4][0])
+    req += struct.pack(">H", destport)
+    resp = bytearray(2 + 4 + 1 + 255 + 2)
+    auth = (proxy[4] != None) and (proxy[5] != None)
+    if auth:
+        await loop.sock_sendall(sock, b'\x05\x02\x00\x02')
+    elif pipeline_socks5:
+        await loop.sock_sendall(sock, b'\x05\x01\x00' + req)
+    else:
+        await loop.sock_sendall(sock, b'\x05\x01\x00')
+    await _arecvall(loop, sock, 2, resp)
+    if resp[0] != 0x05:
+        raise GeneralProxyError((1, _generalerrors[1]))
+    if resp[1] == 0x02 and auth:
+        username, password = _tobytes(proxy[4]), _tobytes(proxy[5])
+        await loop.sock_sendall(sock, struct.pack('BB', 0x01, len(username)) + username +
+                                struct.pack('B', len(password)) + password)
+        authstat = await _arecvall(loop, sock, 2)
+        if authstat[0] != 0x01:
+            raise GeneralProxyError((1, _generalerrors[1]))
+        if authstat[1] != 0x00:
+            raise Socks5AuthError((3, _socks5autherrors[3]))
+    elif resp[1] == 0xFF:
+        raise Socks5AuthError((2, _socks5autherrors[2]))
+    elif resp[1] != 0x00:
+        raise GeneralProxyError((1, _generalerrors[1]))
+    if auth or not pipeline_socks5:
+        await loop.sock_sendall(sock, req)
+    await _arecvall(loop, sock, 5, resp, 2)
+    if resp[2] != 0x05:
+        raise GeneralProxyError((1, _generalerrors[1]))
+    elif resp[3] != 0x00:
+        if resp[3] <= 8:
+            raise Socks5Error((resp[3], _socks5errors[resp[3]]))
+        else:
+            raise Socks5Error((9, _socks5errors[9]))
+    elif resp[5] == 0x01:
+        await _arecvall(loop, sock, 3 + 2, resp, 7)
+    elif resp[5] == 0x03:
+        await _arecvall(loop, sock, resp[6] + 2, resp, 7)
+    elif resp[5] == 0x04:
+        await _arecvall(loop, sock, 15 + 2, resp, 7)
+    else:
+        raise GeneralProxyError((1, _generalerrors[1]))
+
+async def _anegotiatesocks4(loop, sock, proxy, destaddr, destport):
+    rmtrslv = False
+    try:
+        ipaddr = socket.inet_aton(destaddr)
+    except socket.error:
+        if proxy[3]:
+            ipaddr = struct.pack("BBBB", 0x00, 0x00, 0x00, 0x01)
+            rmtrslv = True
+        else:
+            info = await loop.getaddrinfo(destaddr, destport, family=socket.AF_INET, type=socket.SOCK_STREAM)
+            ipaddr = socket.inet_aton(info[0][4][0])
+    req = struct.pack(">BBH", 0x04, 0x01, destport) + ipaddr
+    if proxy[4] != None:
+        req += _tobytes(proxy[4])
+    req += b'\x00'
+    if rmtrslv:
+        req += destaddr.encode('idna') + b'\x00'
+    await loop.sock_sendall(sock, req)
+    resp = await _arecvall(loop, sock, 8)
+    if resp[0] != 0x00:
+        raise GeneralProxyError((1, _generalerrors[1]))
+    if resp[1] != 0x5A:
+        if resp[1] in (91, 92, 93):
+            raise Socks4Error((resp[1], _socks4errors[resp[1] - 90]))
+        else:
+            raise Socks4Error((94, _socks4errors[4]))
+
+async def _anegotiatehttp(loop, sock, proxy, destaddr, destport):
+    if not proxy[3]:
+        info = await loop.getaddrinfo(destaddr, destport, family=socket.AF_INET, type=socket.SOCK_STREAM)
+        addr = info[0][4][0]
+    else:
+        addr = destaddr
+    await loop.sock_sendall(sock, ("CONNECT " + addr + ":" + str(destport) + " HTTP/1.1\r\n" +
+                                   "Host: " + destaddr + "\r\n\r\n").encode())
+    # Read until "\r\n\r\n" without reading past it: ask only for as
+    # many bytes as are still missing from the terminator.
+    resp = bytearray()
+    terminator = b'\r\n\r\n'
+    while not resp.endswith(terminator):
+        matched = 3
+        while matched and not resp.endswith(terminator[:matched]):
+            matched -= 1
+        offset = len(resp)
+        resp.extend(bytes(4 - matched))
+        await _arecvall(loop, sock, 4 - matched, resp, offset)
+    statusline = resp.splitlines()[0].split(b" ", 2)
+    if statusline[0] not in (b"HTTP/1.0", b"HTTP/1.1"):
+        raise GeneralProxyError((1, _generalerrors[1]))
+    try:
+        statuscode = int(statusline[1])
+    except ValueError:
+        raise GeneralProxyError((1, _generalerrors[1]))
+    if statuscode != 200:
+        raise HTTPError((statuscode, statusline[2] if len(statusline) > 2 else b''))
+
+async def create_connection(destaddr, destport, proxy=None, connect_timeout=None, handshake_timeout=None):
+    """create_connection(destaddr, destport[, proxy[, connect_timeout[, handshake_timeout]]]) -> socket
+    Connects to destination through proxy on the running event loop and
+    returns non-blocking socket ready for the destination's protocol.
+    connect_timeout -    Seconds to connect to the proxy itself.
+    handshake_timeout -  Seconds for the proxy negotiation.
+    """
+    if proxy is None:
+        proxy = getdefaultproxy() if getdefaultproxy() != None else (None, None, None, None, None, None)
+    proxy = tuple(proxy) + (None, None, None, None, None, None)[len(proxy):]
+    if proxy[0] == None:
+        proxyaddr, proxyport = destaddr, destport
+    elif proxy[0] in (PROXY_TYPE_SOCKS5, PROXY_TYPE_SOCKS4):
+        proxyaddr, proxyport = proxy[1], proxy[2] if proxy[2] != None else 1080
+    elif proxy[0] == PROXY_TYPE_HTTP:
+        proxyaddr, proxyport = proxy[1], proxy[2] if proxy[2] != None else 8080
+    else:
+        raise GeneralProxyError((4, _generalerrors[4]))
+    if proxy[3] == None:
+        proxy = proxy[:3] + (True,) + proxy[4:]
+
+    loop = asyncio.get_running_loop()
+    info = await loop.getaddrinfo(proxyaddr, proxyport, type=socket.SOCK_STREAM)
+    family, type, proto, canonname, sockaddr = info[0]
+    sock = _orgsocket(family, type, proto)
+    sock.setblocking(False)
+    try:
+        await asyncio.wait_for(loop.sock_connect(sock, sockaddr), connect_timeout)
+        if proxy[0] == PROXY_TYPE_SOCKS5:
+            await asyncio.wait_for(_anegotiatesocks5(loop, sock, proxy, destaddr, destport), handshake_timeout)
+        elif proxy[0] == PROXY_TYPE_SOCKS4:
+            await asyncio.wait_for(_anegotiatesocks4(loop, sock, proxy, destaddr, destport), handshake_timeout)
+        elif proxy[0] == PROXY_TYPE_HTTP:
+            await asyncio.wait_for(_anegotiatehttp(loop, sock, proxy, destaddr, destport), handshake_timeout)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+async def open_connection(destaddr, destport, proxy=None, connect_timeout=None, handshake_timeout=None,
+                          ssl=None, server_hostname=None, **kwds):
+    """open_connection(destaddr, destport[, proxy[, ...]]) -> (reader, writer)
+    Same as create_connection, but returns asyncio stream reader/writer
+    pair. With ssl (True or SSLContext) TLS is started over the proxied
+    connection, handshake_timeout limits it too. Other keywords are passed
+    to asyncio.open_connection.
+    """
+    sock = await create_connection(destaddr, destport, proxy, connect_timeout, handshake_timeout)
+    if ssl:
+        kwds['server_hostname'] = server_hostname if server_hostname != None else destaddr
+        if handshake_timeout is not None:
+            kwds.setdefault('ssl_handshake_timeout', handshake_timeout)
+    try:
+        return await asyncio.open_connection(sock=sock, ssl=ssl, **kwds)
+    except BaseException:
+        sock.close()
+        raise
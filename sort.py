@@ -1,25 +1,30 @@
 #!/usr/bin/env python3
 
-items = []
+import os
+import record
+
+records = {}
 print('reading...')
-f = open('table.txt', 'r', encoding='utf8')
-for line in f:
-    item = line.strip().split(sep='\t')
-    items.append(item)
-f.close()
+# table.txt of crawls made before table.bin first, re-crawled ids replace old rows
+for name in ['table.txt', 'table.bin']:
+    if os.path.isfile(name):
+        for row in record.read_table(name):
+            records[row.id] = row
 
 print('sorting...')
-items.sort(key=lambda x: int(x[3]), reverse=True)
+items = sorted(records.values(), key=lambda row: row.seeds, reverse=True)
 
 print('writing...')
 f = open('table_sorted.txt', 'w', encoding='utf8')
 for item in items:
-    line = ''
-    for subitem in item:
-        line += str(subitem) + '\t'
-    f.write(line + '\n')
+    f.write(item.to_line() + '\n')
 f.close()
 
+print('splitting into chunks...')
+import search
+with open('table_sorted.txt', 'r', encoding='utf8') as f:
+    search.write_chunks(f)
+
 print('compressing...')
 import tarfile
 tar = tarfile.open("table_sorted.tar.bz2", "w:bz2")
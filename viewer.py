@@ -1,61 +1,163 @@
 #!/usr/bin/env python3
 
+import time
+start_time = time.perf_counter()
+
 import sys
-import urllib.parse
+import threading
 from tarfile import TarFile
-import io
-from datetime import datetime
+from array import array
+
+import catalog
+import descrstore
+import hashindex
+import search
+from record import parse_date, format_date
 
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
-from PyQt5.QtWebEngineWidgets import QWebEngineView
+# only the names we need, QtWebEngineWidgets (chromium) is imported on first use
+from PyQt5.QtCore import QAbstractTableModel, QCoreApplication, QModelIndex, Qt, QThread, QTimer, QUrl, pyqtSignal
+from PyQt5.QtGui import QKeySequence
+from PyQt5.QtWidgets import (QAbstractItemView, QApplication, QFrame, QGridLayout, QLabel, QLineEdit, QMainWindow,
+                             QPushButton, QShortcut, QSplitter, QStatusBar, QTableView, QTreeWidget, QTreeWidgetItem)
 
-tree_columns = ('id', 'name', 'size', 'seeds', 'peers', 'hash', 'downloads', 'date', 'category')
+tree_columns = search.columns
 tree_columns_visible = ('ID', 'Название', 'Размер', 'Сиды', 'Пиры', 'Hash', 'Скачиваний', 'Дата', 'Раздел')
 
 
-class NumberSortModel(QSortFilterProxyModel):
-    def lessThan(self, left, right):
-        if not left.data():
-            return True
-        if not right.data():
+def format_size(size):
+    if size < 1024:
+        return '%.0f B' % size
+    elif size < 1024 * 1024:
+        return '%.0f KB' % (size / 1024)
+    elif size < 1024 * 1024 * 1024:
+        return '%.0f MB' % (size / (1024 * 1024))
+    else:
+        return '%.2f GB' % (size / (1024 * 1024 * 1024))
+
+
+class ResultTableModel(QAbstractTableModel):
+    """Table model over search results kept as raw typed columns.
+
+    Numbers are stored in compact arrays and only formatted in data(),
+    sorting goes through a permutation of row indexes and rows are handed
+    to the view lazily by fetchMore().
+    """
+    fetch_batch = 1000
+
+    def __init__(self, parent=None):
+        super(ResultTableModel, self).__init__(parent)
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+        self.clear()
+
+    def clear(self):
+        self.beginResetModel()
+        self.ids = array('q')
+        self.sizes = array('q')
+        self.seeds = array('q')
+        self.peers = array('q')
+        self.downloads = array('q')
+        self.dates = array('q')
+        self.names = []
+        self.hashes = hashindex.HashArray()
+        self.categories = []
+        self.order = array('q')  # view row -> storage index
+        self.loaded = 0
+        self.endResetModel()
+
+    def add_items(self, items):
+        if not items:
+            return
+        start = len(self.ids)
+        for item in items:
+            self.ids.append(int(item[tree_columns.index('id')]))
+            self.names.append(item[tree_columns.index('name')])
+            self.sizes.append(int(item[tree_columns.index('size')]))
+            self.seeds.append(int(item[tree_columns.index('seeds')]))
+            self.peers.append(int(item[tree_columns.index('peers')]))
+            self.hashes.append(item[tree_columns.index('hash')])
+            self.downloads.append(int(item[tree_columns.index('downloads')]))
+            self.dates.append(parse_date(item[tree_columns.index('date')]))
+            self.categories.append(item[tree_columns.index('category')] if len(item) > tree_columns.index('category') else '')
+        self.order.extend(range(start, len(self.ids)))
+        if self.sort_column is not None:
+            self.sort(self.sort_column, self.sort_order)
+
+    def column_values(self, column):
+        name = tree_columns[column]
+        return {'id': self.ids, 'name': self.names, 'size': self.sizes, 'seeds': self.seeds, 'peers': self.peers,
+                'hash': self.hashes, 'downloads': self.downloads, 'date': self.dates,
+                'category': self.categories}[name]
+
+    def row_value(self, row, name):
+        return self.column_values(tree_columns.index(name))[self.order[row]]
+
+    def total_count(self):
+        return len(self.ids)
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(tree_columns)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
             return False
-
-        if left.column() in [tree_columns.index('id'), tree_columns.index('seeds'), tree_columns.index('peers'),
-                             tree_columns.index('downloads')]:
-            lvalue = int(left.data())
-            rvalue = int(right.data())
-        elif left.column() == tree_columns.index('date'):
-            try:
-                lvalue = datetime.strptime(left.data(), '%d-%b-%y %H:%M')
-                rvalue = datetime.strptime(right.data(), '%d-%b-%y %H:%M')
-            except ValueError:
-                lvalue = datetime.strptime(left.data(), '%d-%m-%y %H:%M')
-                rvalue = datetime.strptime(right.data(), '%d-%m-%y %H:%M')
-        elif left.column() == tree_columns.index('size'):
-            lvalue = left.data()
-            rvalue = right.data()
-            if lvalue[-2:] == ' B':
-                lvalue = float(lvalue[:-2])
-            elif lvalue[-3:] == ' KB':
-                lvalue = float(lvalue[:-3]) * 1024
-            elif lvalue[-3:] == ' MB':
-                lvalue = float(lvalue[:-3]) * 1024 * 1024
-            elif lvalue[-3:] == ' GB':
-                lvalue = float(lvalue[:-3]) * 1024 * 1024 * 1024
-            if rvalue[-2:] == ' B':
-                rvalue = float(rvalue[:-2])
-            elif rvalue[-3:] == ' KB':
-                rvalue = float(rvalue[:-3]) * 1024
-            elif rvalue[-3:] == ' MB':
-                rvalue = float(rvalue[:-3]) * 1024 * 1024
-            elif rvalue[-3:] == ' GB':
-                rvalue = float(rvalue[:-3]) * 1024 * 1024 * 1024
+        return self.loaded < len(self.ids)
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid():
+            return
+        count = min(self.fetch_batch, len(self.ids) - self.loaded)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid() or index.row() >= self.loaded:
+            return None
+        column = tree_columns[index.column()]
+        value = self.column_values(index.column())[self.order[index.row()]]
+        if column == 'size':
+            return format_size(value)
+        elif column == 'date':
+            return format_date(value)
+        elif column == 'hash':
+            return value.hex().upper()
+        elif column in ('name', 'category'):
+            return value
+        return str(value)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return tree_columns_visible[section]
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if column < 0:
+            # no sort column - keep rows in search order (by seeds)
+            self.sort_column = None
+            self.layoutAboutToBeChanged.emit()
+            self.order = array('q', range(len(self.ids)))
+            self.layoutChanged.emit()
+            return
+        self.sort_column = column
+        self.sort_order = order
+        values = self.column_values(column)
+        if tree_columns[column] in ('name', 'category'):
+            key = [value.lower() for value in values].__getitem__
         else:
-            lvalue = left.data()
-            rvalue = right.data()
-        return lvalue < rvalue
+            key = values.__getitem__
+        self.layoutAboutToBeChanged.emit()
+        self.order = array('q', sorted(range(len(values)), key=key, reverse=(order == Qt.DescendingOrder)))
+        self.layoutChanged.emit()
 
 
 class MainWindow(QMainWindow):
@@ -64,7 +166,6 @@ class MainWindow(QMainWindow):
         super(MainWindow, self).__init__()
         frame = QFrame(self)
 
-        self.result_count = 0
         self.founded_items = []
 
         self.grid = QGridLayout(frame)
@@ -74,27 +175,24 @@ class MainWindow(QMainWindow):
         self.input2 = QLineEdit()
         self.search = QPushButton()
         self.tree = QTableView()
-        self.webview = QWebEngineView()
-        separator = QSplitter()
+        self.webview = None  # created after window is shown, see do_warm_up
+        self.description = QLabel()
+        self.separator = QSplitter()
         self.statusbar = QStatusBar()
         self.setStatusBar(self.statusbar)
         self.timer = QTimer(self)
         self.timer.setInterval(1000)
         self.timer.timeout.connect(self.do_update_table)
 
-        self.model = QStandardItemModel()
-        proxy = NumberSortModel()
-        proxy.setSourceModel(self.model)
-        self.tree.setModel(proxy)
-        self.model.setColumnCount(len(tree_columns))
-        self.model.setHorizontalHeaderLabels(tree_columns_visible)
+        self.model = ResultTableModel(self)
+        self.tree.setModel(self.model)
         self.tree.verticalHeader().setVisible(False)
         self.tree.setEditTriggers(QAbstractItemView.NoEditTriggers)
-        self.tree.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.tree.setSelectionMode(QAbstractItemView.ExtendedSelection)
+        self.tree.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.tree.horizontalHeader().setSortIndicator(-1, Qt.DescendingOrder)
         self.tree.setSortingEnabled(True)
         self.tree.verticalHeader().setDefaultSectionSize(24)
-        self.webview.setUrl(QUrl("about:blank"))
-        self.webview.setZoomFactor(0.85)
         self.search.setText('Искать')
         self.input2.setMaximumWidth(300)
         self.setWindowTitle('RuTracker database   |   by strayge')
@@ -105,9 +203,9 @@ class MainWindow(QMainWindow):
         self.grid.addWidget(self.input2, 0, 1)
 
         self.grid.addWidget(self.search, 0, 2)
-        self.grid.addWidget(separator, 1, 0, 2, 0)
-        separator.addWidget(self.tree)
-        separator.addWidget(self.webview)
+        self.grid.addWidget(self.separator, 1, 0, 2, 0)
+        self.separator.addWidget(self.tree)
+        self.separator.addWidget(self.description)
 
         self.resize(1500, 800)
         self.tree.resize(2800, 0)
@@ -117,52 +215,104 @@ class MainWindow(QMainWindow):
         self.input2.returnPressed.connect(self.do_search)
         self.tree.clicked.connect(self.do_select)
         self.tree.doubleClicked.connect(self.do_work)
+        QShortcut(QKeySequence.Copy, self.tree, self.do_copy_selected)
 
         self.searcher = None
         self.first_result = False
+        self.descr_store = None
+        self.categories = None  # category tree, only with catalog (see load_categories)
+        self.category_id = None  # selected in tree, searched while input2 shows its path
+        self.category_path = None
+        self.warmed = False
+
+    def showEvent(self, event):
+        super(MainWindow, self).showEvent(event)
+        # heavy parts go after the first paint of the window
+        QTimer.singleShot(200, self.do_warm_up)
+
+    def do_warm_up(self):
+        # window is shown again after minimize too
+        if self.warmed:
+            return
+        self.warmed = True
+        # starting search processes in background, first search won't wait for them
+        threading.Thread(target=search.warm_up, daemon=True).start()
+        self.load_categories()
+        self.get_webview()
+
+    def load_categories(self):
+        try:
+            tree = search.categories()
+        except catalog.OldCatalogError as e:
+            # exception in a Qt slot would abort the viewer
+            self.statusbar.showMessage(str(e))
+            return
+        if not tree:
+            return
+        self.categories = QTreeWidget()
+        self.categories.setHeaderLabels(('Раздел', 'Раздач'))
+        items = {}
+        for category in tree:
+            parent = items.get(category['parent'], self.categories)
+            item = QTreeWidgetItem(parent, (category['name'], str(category['total'])))
+            item.setData(0, Qt.UserRole, category['id'])
+            item.setData(0, Qt.UserRole + 1, category['path'])
+            items[category['id']] = item
+        self.categories.resizeColumnToContents(0)
+        self.categories.itemClicked.connect(self.do_select_category)
+        self.separator.insertWidget(0, self.categories)
+
+    def do_select_category(self, item, column=0):
+        # subtree of the node by id, words of path would match other categories too
+        self.category_id = item.data(0, Qt.UserRole)
+        self.category_path = item.data(0, Qt.UserRole + 1)
+        self.input2.setText(self.category_path)
+        self.do_search()
+
+    def get_webview(self):
+        if self.webview is None:
+            from PyQt5.QtWebEngineWidgets import QWebEngineView
+            self.webview = QWebEngineView()
+            self.webview.setUrl(QUrl("about:blank"))
+            self.webview.setZoomFactor(0.85)
+            self.separator.replaceWidget(1, self.webview)
+            self.description.deleteLater()
+        return self.webview
 
     def do_update_table(self, finish=False):
         if finish:
             self.timer.stop()
-        self.model.setRowCount(len(self.founded_items))
-        for i in range(self.result_count, len(self.founded_items)):
-            for j in range(len(tree_columns)):
-                item = self.founded_items[i]
-                qitem = QStandardItem()
-                qitem.setData(QVariant(item[j]), Qt.DisplayRole)
-                self.model.setItem(i, j, qitem)
-            self.result_count += 1
-
-        # self.tree.sortByColumn(tree_columns.index('seeds'), Qt.DescendingOrder)
-        self.tree.resizeColumnsToContents()
-        if self.tree.columnWidth(tree_columns.index('name')) > 500:
-            self.tree.setColumnWidth(tree_columns.index('name'), 500)
+        items, self.founded_items = self.founded_items, []
+        self.model.add_items(items)
+        if self.model.canFetchMore():
+            self.model.fetchMore()
+
+        # resizing looks at every loaded row, so it is done once per search
+        if self.first_result and self.model.rowCount():
+            self.first_result = False
+            self.tree.resizeColumnsToContents()
+            if self.tree.columnWidth(tree_columns.index('name')) > 500:
+                self.tree.setColumnWidth(tree_columns.index('name'), 500)
         if finish:
             self.timer.stop()
-            self.statusbar.showMessage('Поиск закончен. Найдено %i записей' % len(self.founded_items))
+            self.statusbar.showMessage('Поиск закончен. Найдено %i записей' % self.model.total_count())
             self.search.setText('Поиск')
         else:
-            self.statusbar.showMessage('Идет поиск... Найдено %i записей' % self.result_count)
+            self.statusbar.showMessage('Идет поиск... Найдено %i записей' % self.model.total_count())
 
     def do_add_founded_item(self, item):
-        for j in range(len(tree_columns)):
-            if j == tree_columns.index('size'):
-                size = int(item[j])
-                if size < 1024:
-                    item[j] = '%.0f B' % (float(item[j]))
-                elif size < 1024 * 1024:
-                    item[j] = '%.0f KB' % (float(item[j]) / 1024)
-                elif size < 1024 * 1024 * 1024:
-                    item[j] = '%.0f MB' % (float(item[j]) / (1024 * 1024))
-                else:
-                    item[j] = '%.2f GB' % (float(item[j]) / (1024 * 1024 * 1024))
         self.founded_items.append(item)
 
     def do_show_status(self, text):
         if text == 'Поиск закончен.':
             self.do_update_table(True)
         else:
-            self.statusbar.showMessage(text + ' Найдено %i записей.' % len(self.founded_items))
+            self.statusbar.showMessage(text + ' Найдено %i записей.' % (self.model.total_count() + len(self.founded_items)))
+
+    def do_search_error(self, text):
+        self.timer.stop()
+        self.search.setText('Поиск')
+        self.statusbar.showMessage(text)
 
     def do_search(self):
         if self.search.text() == 'Отмена':
@@ -174,122 +324,104 @@ class MainWindow(QMainWindow):
 
         self.first_result = True
         self.search.setText('Отмена')
-        self.result_count = 0
         self.founded_items = []
-        self.model.setRowCount(0)
-        self.searcher = SearchThread(self.input.text(), self.input2.text())
+        self.model.clear()
+        if self.category_id is not None and self.input2.text() == self.category_path:
+            self.searcher = SearchThread(self.input.text(), '', self.category_id)
+        else:
+            # typed text - words of category path
+            self.category_id = None
+            self.searcher = SearchThread(self.input.text(), self.input2.text())
         self.searcher.add_founded_item.connect(self.do_add_founded_item)
         self.searcher.status.connect(self.do_show_status)
+        self.searcher.error.connect(self.do_search_error)
         self.searcher.start(QThread.LowestPriority)
         self.timer.start()
 
     def do_work(self, index=None):
-        index = self.tree.model().mapToSource( index )
-        
-        name = self.model.item(index.row(), tree_columns.index('name')).text()
-        hash = self.model.item(index.row(), tree_columns.index('hash')).text()
-        args = (
-            ('magnet:?xt=urn:btih:', name),
-            ('dn=', hash),
-            ('tr=', 'udp://tracker.publicbt.com:80'),
-            ('tr=', 'udp://tracker.openbittorrent.com:80'),
-            ('tr=', 'tracker.ccc.de:80'),
-            ('tr=', 'tracker.istole.it:80'),
-            ('tr=', 'udp://tracker.publicbt.com:80')
-        )
-        link = ''
-        for i, j in args:
-            link += i + urllib.parse.quote_plus(j).replace('+', '%20')
+        name = self.model.row_value(index.row(), 'name')
+        hash = self.model.row_value(index.row(), 'hash')
+        link = search.magnet_link(hash, name)
         # noinspection PyArgumentList
         QApplication.clipboard().setText(link)
         print('magnet link copied to clipboard.')
 
+    def do_copy_selected(self):
+        # magnet links of all selected rows, one per line
+        rows = sorted(index.row() for index in self.tree.selectionModel().selectedRows())
+        links = [search.magnet_link(self.model.row_value(row, 'hash'), self.model.row_value(row, 'name'))
+                 for row in rows]
+        if links:
+            # noinspection PyArgumentList
+            QApplication.clipboard().setText('\n'.join(links) + '\n')
+            print('%i magnet links copied to clipboard.' % len(links))
+
+    def get_description(self, id):
+        # deduplicated store (descrstore.py) if there is one, else tar buckets
+        if self.descr_store is None:
+            self.descr_store = descrstore.open_store('descr') or False
+        if self.descr_store:
+            return self.descr_store.get(id)
+        return None
+
     def do_select(self, index=None):
-        id = int(self.model.item(index.row(), tree_columns.index('id')).text())
+        id = self.model.row_value(index.row(), 'id')
+        s = self.get_description(id)
+        if s is not None:
+            self.get_webview().setHtml(s)
+            return
         try:
             archive = TarFile.open('descr/%03i/%05i.tar.bz2' % (id // 100000, id // 1000), 'r:bz2')
             s = archive.extractfile('%08i' % id).read().decode()
             archive.close()
-            self.webview.setHtml(s)
+            self.get_webview().setHtml(s)
         except FileNotFoundError:
-            self.webview.setHtml('Нет описания')
+            self.get_webview().setHtml('Нет описания')
 
 
 class SearchThread(QThread):
     add_founded_item = pyqtSignal(object)
     status = pyqtSignal(object)
+    error = pyqtSignal(object)
 
-    def __init__(self, text, category):
+    def __init__(self, text, category, category_id=None):
         QThread.__init__(self)
         self.text = text
         self.category = category
+        self.category_id = category_id
+        # checked by search also between rows it doesn't find
+        self.cancel = threading.Event()
 
     def stop(self):
+        self.cancel.set()
         self.status.emit('Поиск остановлен.')
-        self.terminate()
 
     def run(self):
-        limit = 20
-        text = self.text
-        category = self.category
-
-        words_contains = []
-        words_not_contains = []
-        words_category = []
-
-        for w in text.split(' '):
-            if (len(w) > 1) and (w[0]) == '-':
-                words_not_contains.append(w[1:])
-            elif (len(w) > len('limit:')) and (w[:6] == 'limit:'):
-                limit = int(w[6:])
-            else:
-                words_contains.append(w)
-        for w in category.split(' '):
-            words_category.append(w)
-
-        archive = TarFile.open('table_sorted.tar.bz2', 'r:bz2')
-        member = archive.members[0]
-        buffered_reader = archive.extractfile(member)
-        buffered_text_reader = io.TextIOWrapper(buffered_reader, encoding='utf8')
-
-        founded_items = 0
-
-        for line in buffered_text_reader:
-            item = line.strip().split(sep='\t')
-            next = False
-            for w in words_contains:
-                if w.lower() in item[tree_columns.index('name')].lower():
-                    pass
-                else:
-                    next = True
-                    break
-            if next:
-                continue
-            for w in words_not_contains:
-                if w.lower() in item[tree_columns.index('name')].lower():
-                    next = True
-                    break
-            if next:
-                continue
-            for w in words_category:
-                if w.lower() in item[tree_columns.index('category')].lower():
-                    pass
-                else:
-                    next = True
-                    break
-            if next:
-                continue
-
-            founded_items += 1
-            self.add_founded_item.emit(item)
-
-            if founded_items >= limit:
-                self.status.emit('Поиск закончен.')
-                break
+        items = search.search(self.text, self.category, cancel=self.cancel, category_id=self.category_id)
+        try:
+            for item in items:
+                if self.cancel.is_set():
+                    items.close()
+                    return
+                self.add_founded_item.emit(item)
+        except ValueError as e:
+            # old catalog or bad query, exception here would abort the viewer
+            self.error.emit(str(e))
+            return
+        if not self.cancel.is_set():
+            self.status.emit('Поиск закончен.')
 
 
 if __name__ == '__main__':
+    # lets QtWebEngineWidgets be imported after QApplication is created
+    QCoreApplication.setAttribute(Qt.AA_ShareOpenGLContexts)
     app = QApplication(sys.argv)
     mainWin = MainWindow()
     mainWin.show()
+    if '--startup-benchmark' in sys.argv:
+        # time until window is shown and event loop is running (see bench_startup.py)
+        def print_startup_time():
+            print('startup: %.3f' % (time.perf_counter() - start_time), flush=True)
+            app.quit()
+        QTimer.singleShot(0, print_startup_time)
     sys.exit(app.exec_())